@@ -1,30 +1,132 @@
-import time
-from typing import Generator
+"""
+Advanced RAGのチェーンを使って質問に回答するStreamlitアプリケーション
 
+実行方法:
+    make streamlit
+"""
+
+from contextlib import closing
+from typing import Generator, Sequence
+
+import openai
 import streamlit as st
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_openai import ChatOpenAI
+
+from app.advanced_rag.cancellation import (
+    CancellationToken,
+    DeadlineExceeded,
+    StreamCancelled,
+)
+from app.advanced_rag.chains.base import AnswerToken, BaseRAGChain, Context, Metrics
+from app.advanced_rag.coalescing import coalesce_tokens
+from app.advanced_rag.factory import chain_constructor_by_name, get_rag_chain
+from app.advanced_rag.resources import VectorStoreBackend
+
+# 1回の回答にかける時間の上限 (秒)
+STREAM_TIMEOUT = 60.0
+
+
+@st.cache_resource
+def get_model(model_name: str) -> BaseChatModel:
+    return ChatOpenAI(model=model_name, reasoning_effort="minimal")
+
+
+def get_chain(
+    chain_name: str, model_name: str, backend: VectorStoreBackend
+) -> BaseRAGChain:
+    # EmbeddingsやChromaを含むチェーンはレジストリでプロセスに1つだけ作り、全セッションで共有する
+    # (チェーンは stream の中で状態を書き換えないため、同時に利用しても安全)
+    return get_rag_chain(chain_name, get_model(model_name), backend)
+
 
-response_message = "Streamlitのセットアップが完了しました！"
+def show_context(documents: Sequence[Document]) -> None:
+    with st.expander(f"検索結果 ({len(documents)}件)"):
+        for document in documents:
+            st.markdown(f"**{document.metadata.get('source', '')}**")
+            st.text(document.page_content)
 
 
-def generate_stream_response() -> Generator[str, None, None]:
-    for char in response_message:
-        time.sleep(0.02)
-        yield char
+def show_metrics(metrics: Metrics) -> None:
+    st.caption(
+        " / ".join(
+            f"{stage}: {seconds * 1000:.0f}ms"
+            for stage, seconds in metrics.timings.items()
+        )
+    )
+
+
+def stream_answer(chain: BaseRAGChain, question: str) -> Generator[str, None, None]:
+    context_placeholder = st.empty()
+
+    # 再実行やページの離脱でこのジェネレーターが閉じられたら、検索と生成も中断する
+    stream = chain.stream(question, CancellationToken(timeout=STREAM_TIMEOUT))
+    with closing(coalesce_tokens(stream)) as chunks:
+        for chunk in chunks:
+            # 検索結果は回答の生成を待たずに表示する
+            if isinstance(chunk, Context):
+                with context_placeholder.container():
+                    show_context(chunk.documents)
+            elif isinstance(chunk, AnswerToken):
+                yield chunk.token
+            elif isinstance(chunk, Metrics):
+                show_metrics(chunk)
 
 
 def app() -> None:
-    st.title("Hello Streamlit")
+    load_dotenv(override=True)
+
+    with st.sidebar:
+        chain_name = st.selectbox(
+            label="RAG Chain Type", options=list(chain_constructor_by_name)
+        )
+        backend = st.selectbox(label="Vector Store", options=["chroma", "faiss"])
+        model_name = st.selectbox(label="Model", options=["gpt-5-nano", "gpt-5-mini"])
 
-    human_message = st.chat_input()
-    if not human_message:
+    st.title("Advanced RAG")
+
+    # 会話履歴はセッションごとに文字列だけを保持する
+    if "messages" not in st.session_state:
+        st.session_state.messages = []
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.write(message["content"])
+
+    question = st.chat_input("質問を入力してください")
+    if not question:
         return
 
     with st.chat_message("human"):
-        st.write(human_message)
+        st.write(question)
 
-    stream = generate_stream_response()
+    try:
+        chain = get_chain(chain_name, model_name, backend)  # type: ignore[arg-type]
+    except ValueError as e:
+        # Chromaにドキュメントを取り込む前は、FAISSのインデックスを作れない
+        st.error(
+            f"ベクトルストアを読み込めませんでした: {e}\n\n"
+            "`uv run python -m app.advanced_rag.ingest` でドキュメントを取り込んでから、"
+            "もう一度お試しください。"
+        )
+        return
     with st.chat_message("ai"):
-        st.write_stream(stream)
+        try:
+            answer = st.write_stream(stream_answer(chain, question))
+        except DeadlineExceeded:
+            st.error("時間内に回答を生成できませんでした。もう一度お試しください。")
+            return
+        except StreamCancelled:
+            st.error("回答の生成を中断しました。")
+            return
+        except openai.APIError as e:
+            st.error(f"OpenAI APIの呼び出しに失敗しました: {e}")
+            return
+
+    # 回答を最後まで生成できたやり取りだけを会話履歴に残す
+    st.session_state.messages.append({"role": "human", "content": question})
+    st.session_state.messages.append({"role": "ai", "content": answer})
 
 
 app()
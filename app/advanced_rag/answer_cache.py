@@ -0,0 +1,150 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Hashable, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app.advanced_rag.chains.base import AnswerToken, Context
+from app.advanced_rag.resources import (
+    DEFAULT_VECTOR_STORE_BACKEND,
+    VectorStoreBackend,
+    get_embeddings,
+    get_vector_store_version_for_backend,
+)
+
+
+@dataclass
+class _Entry:
+    question: str
+    embedding: np.ndarray
+    chunks: list[Context | AnswerToken]
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class SemanticAnswerCache:
+    """
+    質問のEmbeddingのコサイン類似度で、過去の回答 (Context と AnswerToken の列) を引くキャッシュ
+
+    エントリはTTLと最大件数 (古いものから削除) で破棄する。
+    version_fn の値が変わった (ベクトルストアが更新された) 場合はすべて破棄する。
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        similarity_threshold: float = 0.95,
+        ttl_seconds: float | None = 3600.0,
+        max_entries: int = 1000,
+        version_fn: Callable[[], Hashable] | None = None,
+    ):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.version_fn = version_fn
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: list[_Entry] = []
+        self._matrix: np.ndarray | None = None
+        self._version = version_fn() if version_fn else None
+
+    def embed(self, question: str) -> np.ndarray:
+        embedding = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    async def aembed(self, question: str) -> np.ndarray:
+        embedding = np.asarray(
+            await self.embeddings.aembed_query(question), dtype=np.float32
+        )
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def lookup(self, embedding: np.ndarray) -> list[Context | AnswerToken] | None:
+        with self._lock:
+            self._check_version()
+            self._evict_expired()
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            if self._matrix is None:
+                self._matrix = np.stack([entry.embedding for entry in self._entries])
+            similarities = self._matrix @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return self._entries[best].chunks
+
+    def store(
+        self,
+        question: str,
+        embedding: np.ndarray,
+        chunks: Sequence[Context | AnswerToken],
+    ) -> None:
+        with self._lock:
+            self._check_version()
+            self._entries.append(
+                _Entry(question=question, embedding=embedding, chunks=list(chunks))
+            )
+            if len(self._entries) > self.max_entries:
+                del self._entries[: len(self._entries) - self.max_entries]
+            self._matrix = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _check_version(self) -> None:
+        if self.version_fn is None:
+            return
+        version = self.version_fn()
+        if version != self._version:
+            self._version = version
+            self._entries.clear()
+            self._matrix = None
+
+    def _evict_expired(self) -> None:
+        if self.ttl_seconds is None or not self._entries:
+            return
+        # エントリは作成順に並んでいるので、先頭から期限切れのものを削除する
+        deadline = time.monotonic() - self.ttl_seconds
+        expired = 0
+        for entry in self._entries:
+            if entry.created_at >= deadline:
+                break
+            expired += 1
+        if expired:
+            del self._entries[:expired]
+            self._matrix = None
+
+
+def create_semantic_answer_cache(
+    embeddings: Embeddings | None = None,
+    similarity_threshold: float = 0.95,
+    ttl_seconds: float | None = 3600.0,
+    max_entries: int = 1000,
+    backend: VectorStoreBackend = DEFAULT_VECTOR_STORE_BACKEND,
+    directory: str | None = None,
+) -> SemanticAnswerCache:
+    # 回答の根拠にしたベクトルストア (directory にあるChroma、またはFAISSのインデックス) が
+    # 更新されたらキャッシュを破棄する
+    return SemanticAnswerCache(
+        embeddings=embeddings or get_embeddings(),
+        similarity_threshold=similarity_threshold,
+        ttl_seconds=ttl_seconds,
+        max_entries=max_entries,
+        version_fn=partial(get_vector_store_version_for_backend, backend, directory),
+    )
@@ -0,0 +1,468 @@
+"""
+data/examples.csv の質問で、チェーンまたはその検索部分の速度と検索精度を計測するコマンド
+
+--offline を指定すると、Embedding APIの代わりに決定的なローカルのEmbedding (特徴量ハッシング) を使い、
+tmp/langchain-docs (または --synthetic で生成したコーパス) から一時的なインデックスを作成して計測する。
+
+実行方法:
+    uv run python -m app.advanced_rag.benchmark --chain naive --mode retriever --offline --synthetic 100000
+"""
+
+import asyncio
+import csv
+import json
+import os
+import random
+import tempfile
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from glob import glob
+from typing import Literal, Sequence
+
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel, FakeListChatModel
+from langchain_core.vectorstores import VectorStore
+from langchain_text_splitters import MarkdownTextSplitter
+
+from app.advanced_rag.bm25 import BM25Index, tokenize
+from app.advanced_rag.chains.base import BaseRAGChain, Context
+from app.advanced_rag.chains.hybrid import HybridRAGChain
+from app.advanced_rag.chains.semantic_cache import (
+    create_semantic_cache_naive_rag_chain,
+)
+from app.advanced_rag.factory import chain_constructor_by_name
+from app.advanced_rag.faiss_store import FaissVectorStore, build_faiss_index
+from app.advanced_rag.retrieval import aretrieve
+
+BenchmarkMode = Literal["chain", "retriever"]
+
+DEFAULT_EXAMPLES_PATH = "data/examples.csv"
+DEFAULT_SOURCE_DIRECTORY = "tmp/langchain-docs"
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    用語を特徴量ハッシングして作る、決定的でオフラインで動くEmbedding (ベンチマーク用)
+    """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+
+    def _embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in tokenize(text):
+            hashed = zlib.crc32(token.encode())
+            vector[hashed % self.size] += 1.0 if hashed & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+@dataclass
+class Example:
+    question: str
+    source: str
+    answer: str = ""
+
+
+@dataclass
+class ExampleResult:
+    question: str
+    expected_source: str
+    sources: list[str]
+    latency: float
+    time_to_context: float | None = None
+    error: str | None = None
+
+
+@dataclass
+class BenchmarkReport:
+    chain_name: str
+    mode: BenchmarkMode
+    examples: int
+    errors: int
+    corpus_size: int | None
+    recall_at_k: dict[int, float] = field(default_factory=dict)
+    mrr: float = 0.0
+    latency_ms: dict[str, float] = field(default_factory=dict)
+    time_to_context_ms: dict[str, float] = field(default_factory=dict)
+    throughput_qps: float = 0.0
+
+
+def load_examples(path: str = DEFAULT_EXAMPLES_PATH) -> list[Example]:
+    # ExcelなどBOM付きで保存されたCSVも読めるようにする
+    with open(path, "r", encoding="utf-8-sig", newline="") as file:
+        return [
+            Example(
+                question=row["question"],
+                source=row["context"],
+                answer=row.get("answer") or "",
+            )
+            for row in csv.DictReader(file)
+        ]
+
+
+def _split_file(path: str) -> list[Document]:
+    splitter = MarkdownTextSplitter(chunk_size=1000, chunk_overlap=200)
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        return [
+            Document(id=f"{path}#{i}", page_content=chunk, metadata={"source": path})
+            for i, chunk in enumerate(splitter.split_text(file.read()))
+        ]
+
+
+def _load_corpus(source_directory: str) -> list[Document]:
+    documents: list[Document] = []
+    paths = sorted(glob(os.path.join(source_directory, "**/*.mdx"), recursive=True))
+    for path in paths:
+        documents.extend(_split_file(path))
+    return documents
+
+
+def generate_synthetic_corpus(
+    examples: Sequence[Example], size: int, seed: int = 0
+) -> list[Document]:
+    """
+    各質問の正解ファイルのチャンクと、ランダムな用語で作ったノイズのチャンクからなるコーパスを作る
+
+    正解ファイルが手元にあればその実際のチャンクを使い、なければ想定回答にノイズの用語を
+    混ぜたものを正解のチャンクとする (質問の文そのものは使わない)。
+    """
+    rng = random.Random(seed)
+    vocabulary = sorted({token for e in examples for token in tokenize(e.question)})
+    vocabulary += [f"term{i}" for i in range(5000)]
+
+    documents: list[Document] = []
+    for source in dict.fromkeys(example.source for example in examples):
+        if os.path.exists(source):
+            documents.extend(_split_file(source))
+    present = {document.metadata["source"] for document in documents}
+    for i, example in enumerate(examples):
+        if example.source in present:
+            continue
+        documents.append(
+            Document(
+                id=f"relevant-{i}",
+                page_content=" ".join([example.answer, *rng.choices(vocabulary, k=10)]),
+                metadata={"source": example.source},
+            )
+        )
+    for i in range(max(0, size - len(documents))):
+        documents.append(
+            Document(
+                id=f"synthetic-{i}",
+                page_content=" ".join(rng.choices(vocabulary, k=60)),
+                metadata={"source": f"synthetic/{i % 1000}.mdx"},
+            )
+        )
+    return documents
+
+
+def build_offline_vector_store(
+    documents: Sequence[Document],
+    embeddings: Embeddings,
+    backend: str,
+    directory: str,
+) -> VectorStore:
+    if not documents:
+        raise ValueError("corpus is empty")
+    texts = [document.page_content for document in documents]
+    ids = [document.id or str(i) for i, document in enumerate(documents)]
+    metadatas = [document.metadata for document in documents]
+
+    if backend == "faiss":
+        build_faiss_index(
+            directory=directory,
+            vectors=np.asarray(embeddings.embed_documents(texts), dtype=np.float32),
+            ids=ids,
+            contents=texts,
+            metadatas=metadatas,
+            index_type="flat",
+        )
+        return FaissVectorStore.load(directory, embedding=embeddings)
+
+    # Chromaは一度に追加できる件数に上限があるため、分けて追加する
+    vector_store = Chroma(
+        collection_name="benchmark",
+        embedding_function=embeddings,
+        persist_directory=directory,
+    )
+    batch_size = 5000
+    for i in range(0, len(texts), batch_size):
+        vector_store.add_texts(
+            texts[i : i + batch_size],
+            metadatas=metadatas[i : i + batch_size],
+            ids=ids[i : i + batch_size],
+        )
+    return vector_store
+
+
+def _percentiles(values: Sequence[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(np.asarray(values) * 1000, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+async def _run_example(
+    chain: BaseRAGChain, example: Example, mode: BenchmarkMode
+) -> ExampleResult:
+    start = time.perf_counter()
+    documents: Sequence[Document] = []
+    time_to_context = None
+    try:
+        if mode == "retriever":
+            retriever = chain.retriever  # type: ignore[attr-defined]
+            documents = await aretrieve(retriever, example.question)
+        else:
+            async for chunk in chain.astream(example.question):
+                if isinstance(chunk, Context):
+                    documents = chunk.documents
+                    if time_to_context is None:
+                        time_to_context = time.perf_counter() - start
+    except Exception as e:
+        return ExampleResult(
+            question=example.question,
+            expected_source=example.source,
+            sources=[],
+            latency=time.perf_counter() - start,
+            error=f"{type(e).__name__}: {e}",
+        )
+
+    return ExampleResult(
+        question=example.question,
+        expected_source=example.source,
+        sources=[document.metadata.get("source", "") for document in documents],
+        latency=time.perf_counter() - start,
+        time_to_context=time_to_context,
+    )
+
+
+async def run_benchmark(
+    chain: BaseRAGChain,
+    examples: Sequence[Example],
+    mode: BenchmarkMode = "retriever",
+    concurrency: int = 8,
+) -> tuple[list[ExampleResult], float]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(example: Example) -> ExampleResult:
+        async with semaphore:
+            return await _run_example(chain, example, mode)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run(example) for example in examples))
+    return list(results), time.perf_counter() - start
+
+
+def summarize(
+    chain_name: str,
+    mode: BenchmarkMode,
+    results: Sequence[ExampleResult],
+    elapsed: float,
+    ks: Sequence[int] = (1, 3, 5),
+    corpus_size: int | None = None,
+) -> BenchmarkReport:
+    succeeded = [result for result in results if result.error is None]
+
+    def rank(result: ExampleResult) -> int | None:
+        for i, source in enumerate(result.sources):
+            if source == result.expected_source:
+                return i + 1
+        return None
+
+    ranks = [rank(result) for result in succeeded]
+    n = len(succeeded) or 1
+    return BenchmarkReport(
+        chain_name=chain_name,
+        mode=mode,
+        examples=len(results),
+        errors=len(results) - len(succeeded),
+        corpus_size=corpus_size,
+        recall_at_k={
+            k: sum(1 for r in ranks if r is not None and r <= k) / n for k in ks
+        },
+        mrr=sum(1.0 / r for r in ranks if r is not None) / n,
+        latency_ms=_percentiles([result.latency for result in succeeded]),
+        time_to_context_ms=_percentiles(
+            [
+                result.time_to_context
+                for result in succeeded
+                if result.time_to_context is not None
+            ]
+        ),
+        throughput_qps=len(results) / elapsed if elapsed > 0 else 0.0,
+    )
+
+
+def _create_chain(
+    chain_name: str,
+    model: BaseChatModel,
+    vector_store: VectorStore,
+    documents: Sequence[Document] | None,
+    directory: str | None = None,
+) -> BaseRAGChain:
+    if chain_name not in chain_constructor_by_name:
+        raise ValueError(f"Unknown chain name: {chain_name}")
+    # オフラインの場合、ハイブリッド検索のBM25も一時的なコーパスから作る
+    if chain_name == "hybrid" and documents is not None:
+        bm25_index = BM25Index.build(
+            [document.id or "" for document in documents],
+            [document.page_content for document in documents],
+        )
+        return HybridRAGChain(model, vector_store, bm25_index=bm25_index)
+    # キャッシュは一時的なベクトルストアのEmbeddingで比べ、その保存先の更新で破棄する
+    if chain_name == "semantic_cache" and directory is not None:
+        return create_semantic_cache_naive_rag_chain(model, vector_store, directory)
+    return chain_constructor_by_name[chain_name](model, vector_store)
+
+
+def print_report(report: BenchmarkReport) -> None:
+    print(f"chain: {report.chain_name} ({report.mode})")
+    if report.corpus_size is not None:
+        print(f"corpus size: {report.corpus_size}")
+    print(f"examples: {report.examples} (errors: {report.errors})")
+    for k, recall in report.recall_at_k.items():
+        print(f"recall@{k}: {recall:.3f}")
+    print(f"MRR: {report.mrr:.3f}")
+    for name, values in (
+        ("latency", report.latency_ms),
+        ("time to context", report.time_to_context_ms),
+    ):
+        if values:
+            formatted = ", ".join(f"{k}={v:.1f}" for k, v in values.items())
+            print(f"{name} (ms): {formatted}")
+    print(f"throughput: {report.throughput_qps:.1f} q/s")
+
+
+def main():
+    import argparse
+
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(
+        description="RAGチェーンの検索の速度と精度を計測します"
+    )
+    parser.add_argument(
+        "--chain", type=str, default="naive", choices=list(chain_constructor_by_name)
+    )
+    parser.add_argument(
+        "--mode", type=str, default="retriever", choices=["chain", "retriever"]
+    )
+    parser.add_argument("--examples", type=str, default=DEFAULT_EXAMPLES_PATH)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=1, help="各質問を繰り返す回数")
+    parser.add_argument(
+        "--backend", type=str, default="chroma", choices=["chroma", "faiss"]
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="ローカルのEmbeddingと一時的なインデックスで計測する",
+    )
+    parser.add_argument(
+        "--synthetic",
+        type=int,
+        default=0,
+        help="オフライン時に生成する合成コーパスのチャンク数",
+    )
+    parser.add_argument("--model", type=str, default="gpt-4.1-nano")
+    parser.add_argument(
+        "--output", type=str, default=None, help="結果を書き出すJSONのパス"
+    )
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+
+    unique_examples = load_examples(args.examples)
+    examples = unique_examples * args.repeat
+
+    documents: list[Document] | None = None
+    with tempfile.TemporaryDirectory() as directory:
+        if args.offline:
+            # LLMも呼び出さず、固定の回答を返すモデルを使う
+            model: BaseChatModel = FakeListChatModel(responses=["(offline)"])
+            if args.synthetic:
+                documents = generate_synthetic_corpus(unique_examples, args.synthetic)
+            else:
+                documents = _load_corpus(DEFAULT_SOURCE_DIRECTORY)
+            if not documents:
+                parser.error(
+                    f"no documents found in {DEFAULT_SOURCE_DIRECTORY} "
+                    "(download the docs or use --synthetic)"
+                )
+            start = time.perf_counter()
+            vector_store = build_offline_vector_store(
+                documents, HashingEmbeddings(), args.backend, directory
+            )
+            print(
+                f"built offline index of {len(documents)} chunks "
+                f"in {time.perf_counter() - start:.1f}s"
+            )
+        else:
+            from langchain.chat_models import init_chat_model
+
+            from app.advanced_rag.resources import get_vector_store_for_backend
+
+            model = init_chat_model(args.model, model_provider="openai")
+            vector_store = get_vector_store_for_backend(
+                args.backend  # type: ignore[arg-type]
+            )
+
+        try:
+            chain = _create_chain(
+                args.chain,
+                model,
+                vector_store,
+                documents,
+                directory if args.offline else None,
+            )
+        except NotImplementedError:
+            # 構造化出力を使うチェーンは、オフラインの固定モデルでは作れない
+            parser.error(f"{args.chain} chain cannot run with --offline")
+        if args.mode == "retriever" and not hasattr(chain, "retriever"):
+            # ルーティングやキャッシュのチェーンは、単一の検索器を持たない
+            parser.error(
+                f"{args.chain} chain has no single retriever (use --mode chain)"
+            )
+        results, elapsed = asyncio.run(
+            run_benchmark(chain, examples, args.mode, args.concurrency)
+        )
+
+    report = summarize(
+        args.chain,
+        args.mode,
+        results,
+        elapsed,
+        corpus_size=len(documents) if documents is not None else None,
+    )
+    print_report(report)
+    for result in results:
+        if result.error is not None:
+            print(f"error: {result.question}: {result.error}")
+            break
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "report": asdict(report),
+                    "results": [asdict(result) for result in results],
+                },
+                file,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+NumPyで検索するBM25の転置インデックス
+
+(用語, ドキュメント) ごとのBM25の重みを構築時に計算しておき、
+検索時はクエリの用語のポスティングを足し合わせるだけにする。
+
+インデックスの作成方法:
+    uv run python -m app.advanced_rag.bm25
+"""
+
+import json
+import os
+import re
+import unicodedata
+from collections import Counter
+from typing import Sequence
+
+import numpy as np
+from langchain_chroma import Chroma
+
+DEFAULT_BM25_INDEX_DIRECTORY = "./tmp/bm25"
+
+_token_pattern = re.compile(r"[a-z0-9_]+|[぀-ヿ㐀-鿿豈-﫿]+")
+_ascii_pattern = re.compile(r"[a-z0-9_]")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    英数字は単語単位、日本語 (ひらがな・カタカナ・漢字) は文字bigramで分割する
+    """
+    tokens: list[str] = []
+    for match in _token_pattern.finditer(unicodedata.normalize("NFKC", text).lower()):
+        run = match.group()
+        if _ascii_pattern.match(run) or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    def __init__(
+        self,
+        doc_ids: list[str],
+        vocabulary: dict[str, int],
+        indptr: np.ndarray,
+        doc_indices: np.ndarray,
+        weights: np.ndarray,
+        k1: float,
+        b: float,
+    ):
+        self.doc_ids = doc_ids
+        self.vocabulary = vocabulary
+        # 用語ごとのポスティング (CSR形式): indptr[t]:indptr[t+1] が用語tの範囲
+        self.indptr = indptr
+        self.doc_indices = doc_indices
+        self.weights = weights
+        self.k1 = k1
+        self.b = b
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(
+        cls,
+        doc_ids: Sequence[str],
+        texts: Sequence[str],
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> "BM25Index":
+        vocabulary: dict[str, int] = {}
+        term_ids: list[int] = []
+        posting_docs: list[int] = []
+        term_frequencies: list[int] = []
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+
+        for doc_index, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths[doc_index] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                posting_docs.append(doc_index)
+                term_frequencies.append(tf)
+
+        term_id_array = np.asarray(term_ids, dtype=np.int64)
+        doc_index_array = np.asarray(posting_docs, dtype=np.int32)
+        tf_array = np.asarray(term_frequencies, dtype=np.float32)
+
+        # 各ポスティングのBM25の重みを事前に計算する
+        n_docs = len(texts)
+        document_frequencies = np.bincount(term_id_array, minlength=len(vocabulary))
+        idf = np.log(
+            (n_docs - document_frequencies + 0.5) / (document_frequencies + 0.5) + 1.0
+        ).astype(np.float32)
+        average_length = float(doc_lengths.mean()) if n_docs else 1.0
+        length_norm = k1 * (
+            1.0 - b + b * doc_lengths[doc_index_array] / max(average_length, 1.0)
+        )
+        weights = idf[term_id_array] * tf_array * (k1 + 1.0) / (tf_array + length_norm)
+
+        order = np.argsort(term_id_array, kind="stable")
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(document_frequencies, out=indptr[1:])
+
+        return cls(
+            doc_ids=list(doc_ids),
+            vocabulary=vocabulary,
+            indptr=indptr,
+            doc_indices=doc_index_array[order],
+            weights=weights[order].astype(np.float32),
+            k1=k1,
+            b=b,
+        )
+
+    def search(self, query: str, k: int = 5) -> list[tuple[str, float]]:
+        term_ids = {
+            self.vocabulary[token]
+            for token in tokenize(query)
+            if token in self.vocabulary
+        }
+        if not term_ids or not self.doc_ids:
+            return []
+
+        postings = [
+            slice(self.indptr[term_id], self.indptr[term_id + 1])
+            for term_id in term_ids
+        ]
+        doc_indices = np.concatenate([self.doc_indices[p] for p in postings])
+        weights = np.concatenate([self.weights[p] for p in postings])
+        scores = np.bincount(doc_indices, weights=weights, minlength=len(self.doc_ids))
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            top = np.argpartition(-scores[candidates], k - 1)[:k]
+            candidates = candidates[top]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(self.doc_ids[i], float(scores[i])) for i in ranked]
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "indptr.npy"), self.indptr)
+        np.save(os.path.join(directory, "doc_indices.npy"), self.doc_indices)
+        np.save(os.path.join(directory, "weights.npy"), self.weights)
+        terms = [""] * len(self.vocabulary)
+        for term, term_id in self.vocabulary.items():
+            terms[term_id] = term
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as file:
+            json.dump(
+                {"k1": self.k1, "b": self.b, "doc_ids": self.doc_ids, "terms": terms},
+                file,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, directory: str) -> "BM25Index":
+        # ポスティングはメモリマップで読み込み、複数プロセスでページキャッシュを共有する
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        return cls(
+            doc_ids=meta["doc_ids"],
+            vocabulary={term: term_id for term_id, term in enumerate(meta["terms"])},
+            indptr=np.load(os.path.join(directory, "indptr.npy"), mmap_mode="r"),
+            doc_indices=np.load(
+                os.path.join(directory, "doc_indices.npy"), mmap_mode="r"
+            ),
+            weights=np.load(os.path.join(directory, "weights.npy"), mmap_mode="r"),
+            k1=meta["k1"],
+            b=meta["b"],
+        )
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, "meta.json"))
+
+
+def build_bm25_index_from_chroma(
+    vector_store: Chroma, page_size: int = 5000
+) -> BM25Index:
+    doc_ids: list[str] = []
+    texts: list[str] = []
+    offset = 0
+    while True:
+        page = vector_store.get(include=["documents"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        doc_ids.extend(page["ids"])
+        texts.extend(page["documents"])
+        offset += len(page["ids"])
+    return BM25Index.build(doc_ids, texts)
+
+
+def main():
+    import argparse
+    import time
+
+    from dotenv import load_dotenv
+
+    from app.advanced_rag.resources import (
+        DEFAULT_CHROMA_PERSIST_DIRECTORY,
+        get_vector_store,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="ChromaのドキュメントからBM25のインデックスを作成します"
+    )
+    parser.add_argument(
+        "--persist-dir", type=str, default=DEFAULT_CHROMA_PERSIST_DIRECTORY
+    )
+    parser.add_argument("--index-dir", type=str, default=DEFAULT_BM25_INDEX_DIRECTORY)
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+
+    start = time.perf_counter()
+    vector_store = get_vector_store(args.persist_dir)
+    assert isinstance(vector_store, Chroma)
+    index = build_bm25_index_from_chroma(vector_store)
+    index.save(args.index_dir)
+    print(
+        f"indexed {len(index)} chunks, {len(index.vocabulary)} terms "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
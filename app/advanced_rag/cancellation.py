@@ -0,0 +1,175 @@
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Awaitable, Callable, Generator, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# 同期版で Future を待つときに、キャンセルを確認する間隔 (秒)
+_POLL_INTERVAL = 0.05
+
+
+class StreamCancelled(Exception):
+    pass
+
+
+class DeadlineExceeded(StreamCancelled, TimeoutError):
+    pass
+
+
+class CancellationToken:
+    """
+    RAGチェーンの1回の stream を途中で打ち切るためのトークン
+
+    cancel() が呼ばれるか、期限 (timeout 秒後) を過ぎると、チェーンは次のチェックポイント
+    (ステージの間、待ち合わせの途中、回答のチャンクごと) で例外を送出し、上流の接続を閉じる。
+    """
+
+    def __init__(
+        self,
+        timeout: float | None = None,
+        parent: "CancellationToken | None" = None,
+    ):
+        self.parent = parent
+        self._event = threading.Event()
+
+        # 親の期限より後にはならないようにする
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if parent is not None and parent.deadline is not None:
+            deadline = (
+                parent.deadline if deadline is None else min(deadline, parent.deadline)
+            )
+        self.deadline = deadline
+
+    def child(self, timeout: float | None = None) -> "CancellationToken":
+        # 親がキャンセルされると子もキャンセルされる (逆は伝わらない)
+        return CancellationToken(timeout=timeout, parent=self)
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or (
+            self.parent is not None and self.parent.cancelled
+        )
+
+    def remaining(self) -> float | None:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise StreamCancelled("stream was cancelled")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise DeadlineExceeded("stream deadline exceeded")
+
+    def result(self, future: "Future[T]", timeout: float | None = None) -> T:
+        """
+        キャンセルと期限を確認しながら Future の結果を待つ
+
+        timeout を過ぎた場合は concurrent.futures.TimeoutError を送出する。
+        """
+        wait_until = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            self.check()
+            interval = _POLL_INTERVAL
+            remaining = self.remaining()
+            if remaining is not None:
+                interval = min(interval, remaining)
+            if wait_until is not None:
+                interval = min(interval, max(0.0, wait_until - time.monotonic()))
+            try:
+                return future.result(timeout=interval)
+            except FutureTimeoutError:
+                if wait_until is not None and time.monotonic() >= wait_until:
+                    raise
+
+    def call(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        ブロックする呼び出し (APIへのリクエストなど) を別のスレッドで実行し、キャンセルと期限を確認しながら待つ
+
+        打ち切った場合、呼び出し自体は止められないため、結果を捨てて先に戻る。
+        """
+        future: Future[T] = Future()
+        # LangSmithのトレースなどの contextvars を引き継ぐ
+        context = contextvars.copy_context()
+
+        def run() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(context.run(fn, *args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        # 打ち切った呼び出しがスレッドプールを塞がないよう、呼び出しごとにスレッドを作る
+        threading.Thread(target=run, daemon=True).start()
+        return self.result(future)
+
+    def iterate(self, iterator: Iterator[T]) -> Generator[T, None, None]:
+        """
+        ブロックするイテレーター (LLMのストリームなど) を別のスレッドで読み、
+        次の要素を待つ間もキャンセルと期限を確認する
+
+        打ち切ったり閉じたりした場合、読んでいるスレッドが取得中の要素を受け取った時点で
+        イテレーターを閉じ、上流の接続を解放する。
+        """
+        items: queue.Queue[tuple[str, Any]] = queue.Queue()
+        stopped = threading.Event()
+        context = contextvars.copy_context()
+
+        def produce() -> None:
+            try:
+                for item in iterator:
+                    if stopped.is_set():
+                        break
+                    items.put(("item", item))
+                items.put(("done", None))
+            except BaseException as e:
+                items.put(("error", e))
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+
+        threading.Thread(target=context.run, args=(produce,), daemon=True).start()
+        try:
+            while True:
+                self.check()
+                interval = _POLL_INTERVAL
+                remaining = self.remaining()
+                if remaining is not None:
+                    interval = min(interval, remaining)
+                try:
+                    kind, value = items.get(timeout=interval)
+                except queue.Empty:
+                    continue
+                if kind == "done":
+                    return
+                if kind == "error":
+                    raise value
+                yield value
+        finally:
+            stopped.set()
+
+    async def run(self, awaitable: Awaitable[T]) -> T:
+        # 期限を過ぎたら待っている処理をキャンセルする
+        try:
+            self.check()
+        except StreamCancelled:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise
+        try:
+            async with asyncio.timeout(self.remaining()) as scope:
+                return await awaitable
+        except TimeoutError:
+            if scope.expired():
+                raise DeadlineExceeded("stream deadline exceeded") from None
+            raise
@@ -1,8 +1,11 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Any, Generator, Sequence
+from typing import Any, AsyncGenerator, Generator, Sequence
 
 from langchain_core.documents import Document
 
+from app.advanced_rag.cancellation import CancellationToken
+
 
 class Context:
     def __init__(self, documents: Sequence[Document]):
@@ -14,24 +17,63 @@ class AnswerToken:
         self.token = token
 
 
+class Metrics:
+    def __init__(self, timings: dict[str, float]):
+        # ステージ名ごとの所要時間 (秒)
+        self.timings = timings
+
+
 class BaseRAGChain(ABC):
     @abstractmethod
-    def stream(self, question: str) -> Generator[Context | AnswerToken, None, None]:
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
         pass
 
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        # 非同期版を実装していないチェーンは、同期版をスレッドで1チャンクずつ進める
+        cancellation = (cancellation or CancellationToken()).child()
+        iterator = self.stream(question, cancellation)
+        sentinel = object()
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, iterator, sentinel)
+                if chunk is sentinel:
+                    break
+                yield chunk  # type: ignore[misc]
+        finally:
+            # スレッドで実行中の場合は閉じられないため、次のチェックポイントで止まるようにする
+            cancellation.cancel()
+            try:
+                iterator.close()
+            except ValueError:
+                pass
+
 
-def reduce_fn(chunks: Sequence[Context | AnswerToken]) -> Any:
+def _document_reference(document: Document) -> dict[str, Any]:
+    return {"id": document.id, "source": document.metadata.get("source")}
+
+
+def reduce_fn(chunks: Sequence[Context | AnswerToken | Metrics]) -> Any:
     context: Sequence[Document] = []
-    answer: str = ""
+    tokens: list[str] = []
+    timings: dict[str, float] = {}
 
     for chunk in chunks:
         if isinstance(chunk, Context):
             context = chunk.documents
 
         if isinstance(chunk, AnswerToken):
-            answer += chunk.token
+            tokens.append(chunk.token)
+
+        if isinstance(chunk, Metrics):
+            timings = chunk.timings
 
+    # 本文はトレースに含めず、ドキュメントの参照だけを残す
     return {
-        "context": context,
-        "answer": answer,
+        "context": [_document_reference(document) for document in context],
+        "answer": "".join(tokens),
+        "timings": timings,
     }
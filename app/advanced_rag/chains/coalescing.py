@@ -0,0 +1,60 @@
+from contextlib import aclosing
+from typing import AsyncGenerator, Generator
+
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import AnswerToken, BaseRAGChain, Context, Metrics
+from app.advanced_rag.coalescing import (
+    DEFAULT_MAX_CHARS,
+    DEFAULT_MAX_INTERVAL,
+    acoalesce_tokens,
+    coalesce_tokens,
+)
+
+
+class CoalescingRAGChain(BaseRAGChain):
+    """
+    内側のチェーンの AnswerToken をまとめて返すチェーン
+
+    UIの再描画やSSEのフレームの数を減らすためのもので、最初のトークンはまとめずにすぐ返す。
+    """
+
+    def __init__(
+        self,
+        chain: BaseRAGChain,
+        max_chars: int = DEFAULT_MAX_CHARS,
+        max_interval: float = DEFAULT_MAX_INTERVAL,
+    ):
+        self.chain = chain
+        self.max_chars = max_chars
+        self.max_interval = max_interval
+
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        yield from coalesce_tokens(
+            self.chain.stream(question, cancellation),
+            max_chars=self.max_chars,
+            max_interval=self.max_interval,
+        )
+
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        # 途中で閉じられたときに内側のストリームまで確実に閉じる
+        async with aclosing(
+            acoalesce_tokens(
+                self.chain.astream(question, cancellation),
+                max_chars=self.max_chars,
+                max_interval=self.max_interval,
+            )
+        ) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+
+def create_coalescing_rag_chain(
+    chain: BaseRAGChain,
+    max_chars: int = DEFAULT_MAX_CHARS,
+    max_interval: float = DEFAULT_MAX_INTERVAL,
+) -> BaseRAGChain:
+    return CoalescingRAGChain(chain, max_chars=max_chars, max_interval=max_interval)
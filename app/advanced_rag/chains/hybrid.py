@@ -0,0 +1,131 @@
+import asyncio
+import time
+from typing import AsyncGenerator, Generator
+
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
+from langsmith import traceable
+
+from app.advanced_rag.bm25 import BM25Index
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import (
+    AnswerToken,
+    BaseRAGChain,
+    Context,
+    Metrics,
+    reduce_fn,
+)
+from app.advanced_rag.context_packer import DEFAULT_CONTEXT_TOKEN_BUDGET, pack_context
+from app.advanced_rag.fusion import reciprocal_rank_fusion
+from app.advanced_rag.generation import astream_answer, stream_answer
+from app.advanced_rag.metrics import StageTimer
+from app.advanced_rag.resources import get_bm25_index
+from app.advanced_rag.retrieval import aretrieve, retrieve
+
+_generate_answer_prompt_template = '''
+以下の文脈だけを踏まえて質問に回答してください。
+
+文脈: """
+{context}
+"""
+
+質問: {question}
+'''
+
+
+class HybridRAGChain(BaseRAGChain):
+    def __init__(
+        self,
+        model: BaseChatModel,
+        vector_store: VectorStore,
+        bm25_index: BM25Index | None = None,
+        k: int = 5,
+        context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+    ):
+        self.model = model
+        self.k = k
+        self.context_token_budget = context_token_budget
+
+        # ベクトル検索とBM25の検索の準備
+        self.vector_store = vector_store
+        self.retriever = vector_store.as_retriever(search_kwargs={"k": k})
+        self.bm25_index = bm25_index if bm25_index is not None else get_bm25_index()
+
+    def _lexical_search(
+        self, question: str, timer: StageTimer | None = None
+    ) -> list[Document]:
+        start = time.perf_counter()
+        doc_ids = [doc_id for doc_id, _ in self.bm25_index.search(question, k=self.k)]
+        if timer is not None:
+            timer.add("lexical_search", time.perf_counter() - start)
+        if not doc_ids:
+            return []
+        # BM25のインデックスはIDだけを持つので、本文はベクトルストアから取得して順位順に並べ直す
+        documents_by_id = {
+            document.id: document for document in self.vector_store.get_by_ids(doc_ids)
+        }
+        return [documents_by_id[i] for i in doc_ids if i in documents_by_id]
+
+    def _build_prompt(self, question: str, documents: list[Document]) -> str:
+        return _generate_answer_prompt_template.format(
+            context=pack_context(documents, max_tokens=self.context_token_budget),
+            question=question,
+        )
+
+    @traceable(name="hybrid", reduce_fn=reduce_fn)
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        timer = StageTimer("hybrid")
+        cancellation = cancellation or CancellationToken()
+
+        # BM25とベクトル検索の結果をRRFで統合する
+        with timer.measure("retrieval"):
+            lexical_documents = self._lexical_search(question, timer)
+            vector_documents = retrieve(self.retriever, question, timer, cancellation)
+            documents = reciprocal_rank_fusion(
+                [vector_documents, lexical_documents], top_n=self.k
+            )
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        yield from stream_answer(self.model, prompt, timer, cancellation)
+
+        yield timer.finish()
+
+    @traceable(name="hybrid", reduce_fn=reduce_fn)
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        timer = StageTimer("hybrid")
+        cancellation = cancellation or CancellationToken()
+
+        # BM25とベクトル検索を並行して実行し、結果をRRFで統合する
+        with timer.measure("retrieval"):
+            vector_documents, lexical_documents = await asyncio.gather(
+                aretrieve(self.retriever, question, timer, cancellation),
+                cancellation.run(
+                    asyncio.to_thread(self._lexical_search, question, timer)
+                ),
+            )
+            documents = reciprocal_rank_fusion(
+                [vector_documents, lexical_documents], top_n=self.k
+            )
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        async for token in astream_answer(self.model, prompt, timer, cancellation):
+            yield token
+
+        yield timer.finish()
+
+
+def create_hybrid_rag_chain(
+    model: BaseChatModel, vector_store: VectorStore
+) -> BaseRAGChain:
+    return HybridRAGChain(model, vector_store)
@@ -0,0 +1,218 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Generator
+
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
+from langsmith import traceable
+
+from app.advanced_rag.cancellation import CancellationToken, StreamCancelled
+from app.advanced_rag.chains.base import (
+    AnswerToken,
+    BaseRAGChain,
+    Context,
+    Metrics,
+    reduce_fn,
+)
+from app.advanced_rag.context_packer import DEFAULT_CONTEXT_TOKEN_BUDGET, pack_context
+from app.advanced_rag.fusion import reciprocal_rank_fusion
+from app.advanced_rag.generation import astream_answer, stream_answer
+from app.advanced_rag.metrics import StageTimer
+from app.advanced_rag.retrieval import aretrieve, retrieve
+
+_hypothetical_prompt_template = """\
+次の質問に回答する一文を書いてください。
+
+質問: {question}
+"""
+
+_generate_answer_prompt_template = '''
+以下の文脈だけを踏まえて質問に回答してください。
+
+文脈: """
+{context}
+"""
+
+質問: {question}
+'''
+
+
+class HyDERAGChain(BaseRAGChain):
+    """
+    元の質問での検索と、仮説的な回答 (HyDE) での検索を投機的に並行して実行するチェーン
+
+    元の質問での検索結果を先に Context として返し、仮説的な回答での検索が
+    hypothetical_timeout 秒以内に終われば、統合した結果を改めて Context として返す。
+    間に合わなかった場合や失敗した場合は、元の質問での検索結果だけで回答する。
+    """
+
+    def __init__(
+        self,
+        model: BaseChatModel,
+        vector_store: VectorStore,
+        k: int = 5,
+        hypothetical_timeout: float = 5.0,
+        context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+    ):
+        self.model = model
+        self.k = k
+        self.hypothetical_timeout = hypothetical_timeout
+        self.context_token_budget = context_token_budget
+
+        # 検索の準備
+        self.retriever = vector_store.as_retriever(search_kwargs={"k": k})
+
+    def _hypothetical_retrieve(
+        self, question: str, timer: StageTimer, cancellation: CancellationToken
+    ) -> list[Document]:
+        prompt = _hypothetical_prompt_template.format(question=question)
+        with timer.measure("hypothetical_generation"):
+            hypothetical_answer = self.model.invoke(prompt).content
+        # 待つのをやめた後に生成が終わった場合は、誰も使わない検索をしない
+        cancellation.check()
+        return retrieve(
+            self.retriever,
+            hypothetical_answer,  # type: ignore[arg-type]
+            timer,
+            cancellation,
+        )
+
+    async def _ahypothetical_retrieve(
+        self, question: str, timer: StageTimer, cancellation: CancellationToken
+    ) -> list[Document]:
+        prompt = _hypothetical_prompt_template.format(question=question)
+        with timer.measure("hypothetical_generation"):
+            hypothetical_answer = (await self.model.ainvoke(prompt)).content
+        return await aretrieve(
+            self.retriever,
+            hypothetical_answer,  # type: ignore[arg-type]
+            timer,
+            cancellation,
+        )
+
+    def _merge(
+        self, raw_documents: list[Document], hypothetical_documents: list[Document]
+    ) -> list[Document]:
+        return reciprocal_rank_fusion(
+            [raw_documents, hypothetical_documents], top_n=self.k
+        )
+
+    def _build_prompt(self, question: str, documents: list[Document]) -> str:
+        return _generate_answer_prompt_template.format(
+            context=pack_context(documents, max_tokens=self.context_token_budget),
+            question=question,
+        )
+
+    @traceable(name="hyde", reduce_fn=reduce_fn)
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        timer = StageTimer("hyde")
+        cancellation = cancellation or CancellationToken()
+        deadline = time.monotonic() + self.hypothetical_timeout
+
+        # 元の質問での検索と、仮説的な回答の生成・検索を同時に開始する
+        # (仮説的な回答の側は、待つのをやめたら打ち切れるよう子のトークンを渡す)
+        hypothetical_cancellation = cancellation.child()
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            hypothetical_future = executor.submit(
+                self._hypothetical_retrieve,
+                question,
+                timer,
+                hypothetical_cancellation,
+            )
+            raw_future = executor.submit(
+                retrieve, self.retriever, question, timer, cancellation
+            )
+
+            # 元の質問での検索結果を先に返す
+            documents = cancellation.result(raw_future)
+            timer.mark("first_context")
+            yield Context(documents=documents)
+
+            # 仮説的な回答での検索が間に合えば、結果を統合して返し直す
+            with timer.measure("hypothetical_wait"):
+                try:
+                    hypothetical_documents = cancellation.result(
+                        hypothetical_future,
+                        timeout=max(0.0, deadline - time.monotonic()),
+                    )
+                except StreamCancelled:
+                    raise
+                except Exception:
+                    # 時間切れや、LLMの呼び出し・検索の失敗は投機の失敗として扱う
+                    cancellation.check()
+                    hypothetical_documents = None
+            if hypothetical_documents is not None:
+                documents = self._merge(documents, hypothetical_documents)
+                yield Context(documents=documents)
+        finally:
+            # 間に合わなかった処理は終了を待たずに打ち切る
+            hypothetical_cancellation.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        yield from stream_answer(self.model, prompt, timer, cancellation)
+
+        yield timer.finish()
+
+    @traceable(name="hyde", reduce_fn=reduce_fn)
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        timer = StageTimer("hyde")
+        cancellation = cancellation or CancellationToken()
+        deadline = time.monotonic() + self.hypothetical_timeout
+
+        # 元の質問での検索と、仮説的な回答の生成・検索を同時に開始する
+        hypothetical_task = asyncio.create_task(
+            self._ahypothetical_retrieve(question, timer, cancellation)
+        )
+        try:
+            # 元の質問での検索結果を先に返す
+            documents = await aretrieve(self.retriever, question, timer, cancellation)
+            timer.mark("first_context")
+            yield Context(documents=documents)
+
+            # 仮説的な回答での検索が間に合えば、結果を統合して返し直す
+            with timer.measure("hypothetical_wait"):
+                try:
+                    # 全体の期限の方が早ければ、そこまでしか待たない
+                    timeout = max(0.0, deadline - time.monotonic())
+                    remaining = cancellation.remaining()
+                    if remaining is not None:
+                        timeout = min(timeout, remaining)
+                    hypothetical_documents = await asyncio.wait_for(
+                        hypothetical_task, timeout=timeout
+                    )
+                except StreamCancelled:
+                    raise
+                except Exception:
+                    # 時間切れや、LLMの呼び出し・検索の失敗は投機の失敗として扱う
+                    cancellation.check()
+                    hypothetical_documents = None
+            if hypothetical_documents is not None:
+                documents = self._merge(documents, hypothetical_documents)
+                yield Context(documents=documents)
+        finally:
+            # 間に合わなかったLLMの呼び出しはキャンセルする
+            hypothetical_task.cancel()
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        async for token in astream_answer(self.model, prompt, timer, cancellation):
+            yield token
+
+        yield timer.finish()
+
+
+def create_hyde_rag_chain(
+    model: BaseChatModel, vector_store: VectorStore
+) -> BaseRAGChain:
+    return HyDERAGChain(model, vector_store)
@@ -0,0 +1,190 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Generator, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
+from langsmith import traceable
+from pydantic import BaseModel, Field
+
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import (
+    AnswerToken,
+    BaseRAGChain,
+    Context,
+    Metrics,
+    reduce_fn,
+)
+from app.advanced_rag.context_packer import DEFAULT_CONTEXT_TOKEN_BUDGET, pack_context
+from app.advanced_rag.fusion import reciprocal_rank_fusion
+from app.advanced_rag.generation import astream_answer, stream_answer
+from app.advanced_rag.metrics import StageTimer
+from app.advanced_rag.retrieval import (
+    aretrieve,
+    aretrieve_many,
+    retrieve,
+    retrieve_many,
+)
+
+_query_generation_prompt_template = """\
+質問に対してベクトルデータベースから関連文書を検索するために、
+{num_queries}つの異なる検索クエリを生成してください。
+距離ベースの類似性検索の限界を克服するために、
+ユーザーの質問に対して複数の視点を提供することが目標です。
+
+質問: {question}
+"""
+
+_generate_answer_prompt_template = '''
+以下の文脈だけを踏まえて質問に回答してください。
+
+文脈: """
+{context}
+"""
+
+質問: {question}
+'''
+
+
+class QueryGenerationOutput(BaseModel):
+    queries: list[str] = Field(..., description="検索クエリのリスト")
+
+
+class MultiQueryRAGChain(BaseRAGChain):
+    def __init__(
+        self,
+        model: BaseChatModel,
+        vector_store: VectorStore,
+        num_queries: int = 3,
+        max_concurrency: int = 4,
+        context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+        k: int = 5,
+        retrieval_k: int | None = None,
+    ):
+        self.model = model
+        self.num_queries = num_queries
+        self.max_concurrency = max_concurrency
+        self.context_token_budget = context_token_budget
+        self.k = k
+
+        # 検索の準備 (各クエリで retrieval_k 件を取り、統合した結果を k 件に絞る)
+        self.retriever = vector_store.as_retriever(
+            search_kwargs={"k": retrieval_k or k}
+        )
+        self.query_generation_model = model.with_structured_output(
+            QueryGenerationOutput
+        )
+
+    def _merge(self, result_lists: Sequence[Sequence[Document]]) -> list[Document]:
+        # 元の質問と生成したクエリの検索結果をRRFで統合し、上位k件だけを文脈にする
+        return reciprocal_rank_fusion(result_lists, top_n=self.k)
+
+    def _query_generation_prompt(self, question: str) -> str:
+        return _query_generation_prompt_template.format(
+            num_queries=self.num_queries, question=question
+        )
+
+    def _build_prompt(self, question: str, documents: list[Document]) -> str:
+        return _generate_answer_prompt_template.format(
+            context=pack_context(documents, max_tokens=self.context_token_budget),
+            question=question,
+        )
+
+    def _stream(
+        self, question: str, timer: StageTimer, cancellation: CancellationToken
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        with timer.measure("retrieval"):
+            # 検索クエリを1回のLLM呼び出しでまとめて生成し、その間に元の質問での検索を進めておく
+            executor = ThreadPoolExecutor(max_workers=1)
+            try:
+                original_future = executor.submit(
+                    retrieve, self.retriever, question, timer, cancellation
+                )
+                with timer.measure("query_generation"):
+                    output: QueryGenerationOutput = cancellation.call(  # type: ignore[assignment]
+                        self.query_generation_model.invoke,
+                        self._query_generation_prompt(question),
+                    )
+                original_documents = cancellation.result(original_future)
+            finally:
+                # 中断した場合は、元の質問での検索の終了を待たない
+                executor.shutdown(wait=False, cancel_futures=True)
+
+            # 生成したクエリでの検索は並行して実行する
+            result_lists = retrieve_many(
+                self.retriever,
+                output.queries,
+                max_concurrency=self.max_concurrency,
+                timer=timer,
+                cancellation=cancellation,
+            )
+            documents = self._merge([original_documents, *result_lists])
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        yield from stream_answer(self.model, prompt, timer, cancellation)
+
+        yield timer.finish()
+
+    async def _astream(
+        self, question: str, timer: StageTimer, cancellation: CancellationToken
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        async def generate_queries() -> QueryGenerationOutput:
+            with timer.measure("query_generation"):
+                return await self.query_generation_model.ainvoke(  # type: ignore[return-value]
+                    self._query_generation_prompt(question)
+                )
+
+        with timer.measure("retrieval"):
+            # 検索クエリの生成と元の質問での検索を並行して実行する
+            output, original_documents = await asyncio.gather(
+                cancellation.run(generate_queries()),
+                aretrieve(self.retriever, question, timer, cancellation),
+            )
+            result_lists = await aretrieve_many(
+                self.retriever,
+                output.queries,
+                max_concurrency=self.max_concurrency,
+                timer=timer,
+                cancellation=cancellation,
+            )
+            documents = self._merge([original_documents, *result_lists])
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        async for token in astream_answer(self.model, prompt, timer, cancellation):
+            yield token
+
+        yield timer.finish()
+
+    @traceable(name="multi_query", reduce_fn=reduce_fn)
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        yield from self._stream(
+            question,
+            StageTimer("multi_query"),
+            cancellation or CancellationToken(),
+        )
+
+    @traceable(name="multi_query", reduce_fn=reduce_fn)
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        async for chunk in self._astream(
+            question,
+            StageTimer("multi_query"),
+            cancellation or CancellationToken(),
+        ):
+            yield chunk
+
+
+def create_multi_query_rag_chain(
+    model: BaseChatModel, vector_store: VectorStore
+) -> BaseRAGChain:
+    return MultiQueryRAGChain(model, vector_store)
@@ -1,11 +1,22 @@
-from typing import Generator
+from typing import AsyncGenerator, Generator
 
-from langchain.embeddings import init_embeddings
-from langchain_chroma import Chroma
+from langchain_core.documents import Document
 from langchain_core.language_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
 from langsmith import traceable
 
-from app.advanced_rag.chains.base import AnswerToken, BaseRAGChain, Context, reduce_fn
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import (
+    AnswerToken,
+    BaseRAGChain,
+    Context,
+    Metrics,
+    reduce_fn,
+)
+from app.advanced_rag.context_packer import DEFAULT_CONTEXT_TOKEN_BUDGET, pack_context
+from app.advanced_rag.generation import astream_answer, stream_answer
+from app.advanced_rag.metrics import StageTimer
+from app.advanced_rag.retrieval import aretrieve, retrieve
 
 _generate_answer_prompt_template = '''
 以下の文脈だけを踏まえて質問に回答してください。
@@ -19,31 +30,65 @@ _generate_answer_prompt_template = '''
 
 
 class NaiveRAGChain(BaseRAGChain):
-    def __init__(self, model: BaseChatModel):
+    def __init__(
+        self,
+        model: BaseChatModel,
+        vector_store: VectorStore,
+        context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+    ):
         self.model = model
+        self.context_token_budget = context_token_budget
 
-        # 検索の準備
-        embeddings = init_embeddings(model="text-embedding-3-small", provider="openai")
-        vector_store = Chroma(
-            embedding_function=embeddings,
-            persist_directory="./tmp/chroma",
-        )
+        # 検索の準備 (ベクトルストアはプロセス内で共有されたものを受け取る)
         self.retriever = vector_store.as_retriever(search_kwargs={"k": 5})
 
+    def _build_prompt(self, question: str, documents: list[Document]) -> str:
+        return _generate_answer_prompt_template.format(
+            context=pack_context(documents, max_tokens=self.context_token_budget),
+            question=question,
+        )
+
     @traceable(name="naive", reduce_fn=reduce_fn)
-    def stream(self, question: str) -> Generator[Context | AnswerToken, None, None]:
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        timer = StageTimer("naive")
+        cancellation = cancellation or CancellationToken()
+
         # 検索して検索結果を返す
-        documents = self.retriever.invoke(question)
+        with timer.measure("retrieval"):
+            documents = retrieve(self.retriever, question, timer, cancellation)
         yield Context(documents=documents)
 
         # 回答を生成して徐々に応答を返す
-        prompt = _generate_answer_prompt_template.format(
-            context=documents,
-            question=question,
-        )
-        for chunk in self.model.stream(prompt):
-            yield AnswerToken(token=chunk.content)
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        yield from stream_answer(self.model, prompt, timer, cancellation)
+
+        yield timer.finish()
+
+    @traceable(name="naive", reduce_fn=reduce_fn)
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        timer = StageTimer("naive")
+        cancellation = cancellation or CancellationToken()
+
+        # 検索して検索結果を返す
+        with timer.measure("retrieval"):
+            documents = await aretrieve(self.retriever, question, timer, cancellation)
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        async for token in astream_answer(self.model, prompt, timer, cancellation):
+            yield token
+
+        yield timer.finish()
 
 
-def create_naive_rag_chain(model: BaseChatModel) -> BaseRAGChain:
-    return NaiveRAGChain(model)
+def create_naive_rag_chain(
+    model: BaseChatModel, vector_store: VectorStore
+) -> BaseRAGChain:
+    return NaiveRAGChain(model, vector_store)
@@ -0,0 +1,57 @@
+from typing import Any, AsyncGenerator, Generator
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
+from langsmith import traceable
+
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import (
+    AnswerToken,
+    BaseRAGChain,
+    Context,
+    Metrics,
+    reduce_fn,
+)
+from app.advanced_rag.chains.multi_query import MultiQueryRAGChain
+from app.advanced_rag.metrics import StageTimer
+
+
+class RAGFusionChain(MultiQueryRAGChain):
+    # クエリの生成、並行検索、RRFでの統合は MultiQueryRAGChain と同じで、
+    # 各クエリで深めに (retrieval_k 件) 検索してから上位k件に絞る
+    def __init__(
+        self,
+        model: BaseChatModel,
+        vector_store: VectorStore,
+        k: int = 5,
+        retrieval_k: int = 10,
+        **kwargs: Any,
+    ):
+        super().__init__(model, vector_store, k=k, retrieval_k=retrieval_k, **kwargs)
+
+    @traceable(name="rag_fusion", reduce_fn=reduce_fn)
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        yield from self._stream(
+            question,
+            StageTimer("rag_fusion"),
+            cancellation or CancellationToken(),
+        )
+
+    @traceable(name="rag_fusion", reduce_fn=reduce_fn)
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        async for chunk in self._astream(
+            question,
+            StageTimer("rag_fusion"),
+            cancellation or CancellationToken(),
+        ):
+            yield chunk
+
+
+def create_rag_fusion_chain(
+    model: BaseChatModel, vector_store: VectorStore
+) -> BaseRAGChain:
+    return RAGFusionChain(model, vector_store)
@@ -0,0 +1,106 @@
+from typing import AsyncGenerator, Generator
+
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
+from langsmith import traceable
+
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import (
+    AnswerToken,
+    BaseRAGChain,
+    Context,
+    Metrics,
+    reduce_fn,
+)
+from app.advanced_rag.context_packer import DEFAULT_CONTEXT_TOKEN_BUDGET, pack_context
+from app.advanced_rag.generation import astream_answer, stream_answer
+from app.advanced_rag.metrics import StageTimer
+from app.advanced_rag.rerank import Reranker
+from app.advanced_rag.retrieval import aretrieve, retrieve
+
+_generate_answer_prompt_template = '''
+以下の文脈だけを踏まえて質問に回答してください。
+
+文脈: """
+{context}
+"""
+
+質問: {question}
+'''
+
+
+class RerankRAGChain(BaseRAGChain):
+    def __init__(
+        self,
+        model: BaseChatModel,
+        vector_store: VectorStore,
+        reranker: Reranker | None = None,
+        context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+    ):
+        self.model = model
+        self.context_token_budget = context_token_budget
+        self.reranker = reranker or Reranker()
+
+        # 検索の準備 (リランクの候補として多めに取得する)
+        self.retriever = vector_store.as_retriever(
+            search_kwargs={"k": self.reranker.max_candidates}
+        )
+
+    def _build_prompt(self, question: str, documents: list[Document]) -> str:
+        return _generate_answer_prompt_template.format(
+            context=pack_context(documents, max_tokens=self.context_token_budget),
+            question=question,
+        )
+
+    @traceable(name="rerank", reduce_fn=reduce_fn)
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        timer = StageTimer("rerank")
+        cancellation = cancellation or CancellationToken()
+
+        # 検索してリランクした結果を返す
+        with timer.measure("retrieval"):
+            candidates = retrieve(self.retriever, question, timer, cancellation)
+        with timer.measure("rerank"):
+            cancellation.check()
+            documents = self.reranker.rerank(question, candidates)
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        yield from stream_answer(self.model, prompt, timer, cancellation)
+
+        yield timer.finish()
+
+    @traceable(name="rerank", reduce_fn=reduce_fn)
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        timer = StageTimer("rerank")
+        cancellation = cancellation or CancellationToken()
+
+        # 検索してリランクした結果を返す
+        with timer.measure("retrieval"):
+            candidates = await aretrieve(self.retriever, question, timer, cancellation)
+        with timer.measure("rerank"):
+            documents = await cancellation.run(
+                self.reranker.arerank(question, candidates)
+            )
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        async for token in astream_answer(self.model, prompt, timer, cancellation):
+            yield token
+
+        yield timer.finish()
+
+
+def create_rerank_rag_chain(
+    model: BaseChatModel, vector_store: VectorStore
+) -> BaseRAGChain:
+    return RerankRAGChain(model, vector_store)
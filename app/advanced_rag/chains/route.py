@@ -0,0 +1,188 @@
+from enum import Enum
+from typing import AsyncGenerator, Generator
+
+from langchain_community.retrievers import TavilySearchAPIRetriever
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from langsmith import traceable
+from pydantic import BaseModel
+
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import (
+    AnswerToken,
+    BaseRAGChain,
+    Context,
+    Metrics,
+    reduce_fn,
+)
+from app.advanced_rag.context_packer import DEFAULT_CONTEXT_TOKEN_BUDGET, pack_context
+from app.advanced_rag.generation import astream_answer, stream_answer
+from app.advanced_rag.metrics import StageTimer
+from app.advanced_rag.resources import get_embeddings
+from app.advanced_rag.retrieval import aretrieve, retrieve
+from app.advanced_rag.router import LocalRouter, RouteDecision
+
+
+class Route(str, Enum):
+    langchain_document = "langchain_document"
+    web = "web"
+
+
+class RouteOutput(BaseModel):
+    route: Route
+
+
+# 経路ごとの例文 (重心の計算に使う)
+_route_examples: dict[str, list[str]] = {
+    Route.langchain_document.value: [
+        "LangChainの概要を教えて",
+        "LangSmithでトレースを確認する方法",
+        "LangGraphでエージェントを作るには",
+        "Retrieverの使い方",
+        "オフライン評価でLLM-as-a-judgeをするには",
+    ],
+    Route.web.value: [
+        "今日の東京の天気は？",
+        "最新のニュースを教えて",
+        "現在の為替レートはいくら？",
+        "今週のスポーツの試合結果",
+        "昨日発表された新製品について",
+    ],
+}
+
+# 一方の経路にだけ一致するキーワードがあれば、Embeddingを使わずに決める
+_route_keywords: dict[str, list[str]] = {
+    Route.langchain_document.value: ["langchain", "langsmith", "langgraph", "lcel"],
+    Route.web.value: ["天気", "ニュース", "株価", "為替", "今日", "最新"],
+}
+
+_route_prompt_template = """\
+質問に回答するために適切なRetrieverを選択してください。
+
+質問: {question}
+"""
+
+_generate_answer_prompt_template = '''
+以下の文脈だけを踏まえて質問に回答してください。
+
+文脈: """
+{context}
+"""
+
+質問: {question}
+'''
+
+
+class RouteRAGChain(BaseRAGChain):
+    def __init__(
+        self,
+        model: BaseChatModel,
+        vector_store: VectorStore,
+        router: LocalRouter | None = None,
+        context_token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+    ):
+        self.model = model
+        self.context_token_budget = context_token_budget
+
+        # 検索の準備
+        self.retrievers: dict[str, BaseRetriever] = {
+            Route.langchain_document.value: vector_store.as_retriever(
+                search_kwargs={"k": 5}
+            ),
+            Route.web.value: TavilySearchAPIRetriever(k=3),
+        }
+
+        # ルーティングはローカルで行い、自信度が低い場合だけLLMに判断させる
+        self.router = router or LocalRouter(
+            embeddings=vector_store.embeddings or get_embeddings(),
+            examples_by_route=_route_examples,
+            keywords_by_route=_route_keywords,
+        )
+        self.route_model = model.with_structured_output(RouteOutput)
+
+    @traceable(name="route_question")
+    def _route(self, question: str, cancellation: CancellationToken) -> RouteDecision:
+        # 質問のEmbeddingとLLMへの問い合わせは、キャンセルや期限切れで待つのをやめられるようにする
+        decision = cancellation.call(self.router.route, question)
+        if decision.method != "centroid" or (
+            decision.confidence >= self.router.min_confidence
+        ):
+            return decision
+
+        prompt = _route_prompt_template.format(question=question)
+        output: RouteOutput = cancellation.call(self.route_model.invoke, prompt)  # type: ignore[assignment]
+        return self.router.record_llm_decision(output.route.value, decision.confidence)
+
+    @traceable(name="route_question")
+    async def _aroute(self, question: str) -> RouteDecision:
+        decision = await self.router.aroute(question)
+        if decision.method != "centroid" or (
+            decision.confidence >= self.router.min_confidence
+        ):
+            return decision
+
+        prompt = _route_prompt_template.format(question=question)
+        output: RouteOutput = await self.route_model.ainvoke(prompt)  # type: ignore[assignment]
+        return self.router.record_llm_decision(output.route.value, decision.confidence)
+
+    def _build_prompt(self, question: str, documents: list[Document]) -> str:
+        return _generate_answer_prompt_template.format(
+            context=pack_context(documents, max_tokens=self.context_token_budget),
+            question=question,
+        )
+
+    @traceable(name="route", reduce_fn=reduce_fn)
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        timer = StageTimer("route")
+        cancellation = cancellation or CancellationToken()
+
+        # 質問の振り分け先を決めて検索し、検索結果を返す
+        with timer.measure("routing"):
+            decision = self._route(question, cancellation)
+        with timer.measure("retrieval"):
+            cancellation.check()
+            documents = retrieve(
+                self.retrievers[decision.route], question, timer, cancellation
+            )
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        yield from stream_answer(self.model, prompt, timer, cancellation)
+
+        yield timer.finish()
+
+    @traceable(name="route", reduce_fn=reduce_fn)
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        timer = StageTimer("route")
+        cancellation = cancellation or CancellationToken()
+
+        # 質問の振り分け先を決めて検索し、検索結果を返す
+        with timer.measure("routing"):
+            decision = await cancellation.run(self._aroute(question))
+        with timer.measure("retrieval"):
+            documents = await aretrieve(
+                self.retrievers[decision.route], question, timer, cancellation
+            )
+        yield Context(documents=documents)
+
+        # 回答を生成して徐々に応答を返す
+        with timer.measure("prompt_build"):
+            prompt = self._build_prompt(question, documents)
+        async for token in astream_answer(self.model, prompt, timer, cancellation):
+            yield token
+
+        yield timer.finish()
+
+
+def create_route_rag_chain(
+    model: BaseChatModel, vector_store: VectorStore
+) -> BaseRAGChain:
+    return RouteRAGChain(model, vector_store)
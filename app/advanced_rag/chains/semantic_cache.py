@@ -0,0 +1,108 @@
+from typing import AsyncGenerator, Generator
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
+from langsmith import traceable
+
+from app.advanced_rag.answer_cache import (
+    SemanticAnswerCache,
+    create_semantic_answer_cache,
+)
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import (
+    AnswerToken,
+    BaseRAGChain,
+    Context,
+    Metrics,
+    reduce_fn,
+)
+from app.advanced_rag.chains.naive import create_naive_rag_chain
+from app.advanced_rag.metrics import StageTimer
+from app.advanced_rag.resources import get_backend_of
+
+
+def _merge_timings(timer: StageTimer, metrics: Metrics) -> None:
+    # 内側のチェーンのステージ別の時間を引き継ぐ (合計はこのチェーンで計測する)
+    for stage, seconds in metrics.timings.items():
+        if stage != "total":
+            timer.add(stage, seconds)
+
+
+class SemanticCacheRAGChain(BaseRAGChain):
+    def __init__(self, chain: BaseRAGChain, cache: SemanticAnswerCache):
+        self.chain = chain
+        self.cache = cache
+
+    @traceable(name="semantic_cache", reduce_fn=reduce_fn)
+    def stream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> Generator[Context | AnswerToken | Metrics, None, None]:
+        timer = StageTimer("semantic_cache")
+        cancellation = cancellation or CancellationToken()
+
+        # 似た質問の回答がキャッシュにあれば、検索も生成もせずにそのまま返す
+        with timer.measure("semantic_cache_lookup"):
+            embedding = cancellation.call(self.cache.embed, question)
+            cached_chunks = self.cache.lookup(embedding)
+        if cached_chunks is not None:
+            yield from cached_chunks
+            yield timer.finish()
+            return
+
+        # 最後まで生成できた回答だけをキャッシュする
+        chunks: list[Context | AnswerToken] = []
+        for chunk in self.chain.stream(question, cancellation):
+            if isinstance(chunk, Metrics):
+                _merge_timings(timer, chunk)
+                continue
+            chunks.append(chunk)
+            yield chunk
+        self.cache.store(question, embedding, chunks)
+        yield timer.finish()
+
+    @traceable(name="semantic_cache", reduce_fn=reduce_fn)
+    async def astream(
+        self, question: str, cancellation: CancellationToken | None = None
+    ) -> AsyncGenerator[Context | AnswerToken | Metrics, None]:
+        timer = StageTimer("semantic_cache")
+        cancellation = cancellation or CancellationToken()
+
+        with timer.measure("semantic_cache_lookup"):
+            embedding = await cancellation.run(self.cache.aembed(question))
+            cached_chunks = self.cache.lookup(embedding)
+        if cached_chunks is not None:
+            for chunk in cached_chunks:
+                yield chunk
+            yield timer.finish()
+            return
+
+        chunks: list[Context | AnswerToken] = []
+        async for chunk in self.chain.astream(question, cancellation):
+            if isinstance(chunk, Metrics):
+                _merge_timings(timer, chunk)
+                continue
+            chunks.append(chunk)
+            yield chunk
+        self.cache.store(question, embedding, chunks)
+        yield timer.finish()
+
+
+def create_semantic_cache_rag_chain(
+    chain: BaseRAGChain, cache: SemanticAnswerCache
+) -> BaseRAGChain:
+    return SemanticCacheRAGChain(chain, cache)
+
+
+def create_semantic_cache_naive_rag_chain(
+    model: BaseChatModel, vector_store: VectorStore, directory: str | None = None
+) -> BaseRAGChain:
+    # naiveのチェーンの前にキャッシュを置く。質問はベクトルストアと同じEmbeddingで比べ、
+    # directory (省略時はデフォルトの保存先) にあるベクトルストアの更新でキャッシュを破棄する
+    return SemanticCacheRAGChain(
+        create_naive_rag_chain(model, vector_store),
+        create_semantic_answer_cache(
+            embeddings=vector_store.embeddings,
+            backend=get_backend_of(vector_store),
+            directory=directory,
+        ),
+    )
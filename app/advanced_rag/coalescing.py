@@ -0,0 +1,137 @@
+import asyncio
+import time
+from typing import AsyncIterator, Iterator, TypeVar
+
+from app.advanced_rag.chains.base import AnswerToken
+
+DEFAULT_MAX_CHARS = 64
+DEFAULT_MAX_INTERVAL = 0.03
+
+T = TypeVar("T")
+
+
+class _TokenBuffer:
+    def __init__(self, max_chars: int, max_interval: float):
+        self.max_chars = max_chars
+        self.max_interval = max_interval
+        self.tokens: list[str] = []
+        self.size = 0
+        self.first = True
+        self.last_flush = time.perf_counter()
+
+    def add(self, token: str) -> None:
+        # 空のトークン (OpenAIの最初のチャンクのroleだけの差分など) で
+        # 「最初のトークンはすぐに返す」の1回を使わないよう、溜めない
+        if not token:
+            return
+        self.tokens.append(token)
+        self.size += len(token)
+
+    def due(self) -> bool:
+        # 最初のトークンは待たずに返し、以降は文字数か経過時間の上限で返す
+        return (
+            self.first
+            or self.size >= self.max_chars
+            or time.perf_counter() - self.last_flush >= self.max_interval
+        )
+
+    def wait_time(self) -> float:
+        return max(0.0, self.max_interval - (time.perf_counter() - self.last_flush))
+
+    def flush(self) -> AnswerToken | None:
+        if not self.tokens:
+            return None
+        token = AnswerToken(token="".join(self.tokens))
+        self.tokens.clear()
+        self.size = 0
+        self.first = False
+        self.last_flush = time.perf_counter()
+        return token
+
+
+def coalesce_tokens(
+    chunks: Iterator[T],
+    max_chars: int = DEFAULT_MAX_CHARS,
+    max_interval: float = DEFAULT_MAX_INTERVAL,
+) -> Iterator[T | AnswerToken]:
+    """
+    連続する AnswerToken を、max_chars 文字か max_interval 秒ごとにまとめて返す
+
+    AnswerToken 以外のチャンクは、溜まっているトークンを先に返してからそのまま返す。
+    同期版では次のチャンクが届いた時点でしか時間の上限を確認できない。
+    """
+    buffer = _TokenBuffer(max_chars, max_interval)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, AnswerToken):
+                buffer.add(chunk.token)
+                if buffer.due() and (token := buffer.flush()) is not None:
+                    yield token
+                continue
+
+            if (token := buffer.flush()) is not None:
+                yield token
+            yield chunk
+
+        if (token := buffer.flush()) is not None:
+            yield token
+    finally:
+        # 途中で閉じられた場合は、元のストリームも閉じて上流の接続を解放させる
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+async def acoalesce_tokens(
+    chunks: AsyncIterator[T],
+    max_chars: int = DEFAULT_MAX_CHARS,
+    max_interval: float = DEFAULT_MAX_INTERVAL,
+) -> AsyncIterator[T | AnswerToken]:
+    """
+    coalesce_tokens の非同期版
+
+    次のチャンクを待つ間に max_interval 秒を過ぎた場合も、溜まっているトークンを返す。
+    """
+    buffer = _TokenBuffer(max_chars, max_interval)
+    iterator = aiter(chunks)
+    pending: asyncio.Future | None = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(anext(iterator))
+
+            # トークンが溜まっている間は、上限の時間までしか待たない
+            if buffer.tokens:
+                done, _ = await asyncio.wait({pending}, timeout=buffer.wait_time())
+                if not done:
+                    if (token := buffer.flush()) is not None:
+                        yield token
+                    continue
+
+            try:
+                chunk = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if isinstance(chunk, AnswerToken):
+                buffer.add(chunk.token)
+                if buffer.due() and (token := buffer.flush()) is not None:
+                    yield token
+                continue
+
+            if (token := buffer.flush()) is not None:
+                yield token
+            yield chunk
+
+        if (token := buffer.flush()) is not None:
+            yield token
+    finally:
+        # 途中で閉じられた場合は、待っている次のチャンクの取得を取り消してから元のストリームも閉じる
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
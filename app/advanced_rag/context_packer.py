@@ -0,0 +1,156 @@
+import hashlib
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Any, Sequence
+
+from langchain_core.documents import Document
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 2000
+
+# 出典として残すメタデータのキー (それ以外はプロンプトに含めない)
+_kept_metadata_keys = ("source",)
+
+# 残り予算がこれより少なければ、途中で切ったチャンクを入れずに打ち切る
+_min_truncated_tokens = 50
+
+# 共通部分の割合がこれ以上のチャンクは重複とみなす
+_overlap_threshold = 0.8
+_shingle_size = 5
+
+_whitespace_pattern = re.compile(r"\s+")
+_cjk_pattern = re.compile(r"[぀-ヿ㐀-鿿豈-﫿ｦ-ﾟ]")
+
+
+@lru_cache(maxsize=1)
+def _get_encoding() -> Any:
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # オフライン環境などでエンコーディングを取得できない場合は概算にする
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    # 日本語は1文字1トークン程度、それ以外は4文字1トークン程度として概算する
+    cjk_chars = len(_cjk_pattern.findall(text))
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return encoding.decode(tokens[:max_tokens])
+
+    # 概算の場合は、文字数の比率で切り詰める
+    total = count_tokens(text)
+    if total <= max_tokens:
+        return text
+    return text[: len(text) * max_tokens // total]
+
+
+def _normalize(text: str) -> str:
+    return _whitespace_pattern.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def _shingles(text: str) -> set[str]:
+    if len(text) <= _shingle_size:
+        return {text}
+    return {text[i : i + _shingle_size] for i in range(len(text) - _shingle_size + 1)}
+
+
+def _score(document: Document) -> float | None:
+    for key in ("relevance_score", "score"):
+        value = document.metadata.get(key)
+        if isinstance(value, (int, float)):
+            return float(value)
+    return None
+
+
+def order_by_score(documents: Sequence[Document]) -> list[Document]:
+    # スコアがなければ検索結果の順位 (スコア順) のまま使う
+    scores = [_score(document) for document in documents]
+    if any(score is None for score in scores):
+        return list(documents)
+    ranked = sorted(
+        zip(scores, documents),
+        key=lambda pair: pair[0],
+        reverse=True,  # type: ignore[arg-type, return-value]
+    )
+    return [document for _, document in ranked]
+
+
+def deduplicate(documents: Sequence[Document]) -> list[Document]:
+    selected: list[Document] = []
+    selected_hashes: set[str] = set()
+    selected_shingles: list[set[str]] = []
+
+    for document in documents:
+        normalized = _normalize(document.page_content)
+        if not normalized:
+            continue
+
+        content_hash = hashlib.sha1(normalized.encode()).hexdigest()
+        if content_hash in selected_hashes:
+            continue
+
+        # 一方が他方をほぼ含む (チャンクのオーバーラップなど) 場合も重複とみなす
+        shingles = _shingles(normalized)
+        if any(
+            len(shingles & other) >= _overlap_threshold * min(len(shingles), len(other))
+            for other in selected_shingles
+        ):
+            continue
+
+        selected.append(document)
+        selected_hashes.add(content_hash)
+        selected_shingles.append(shingles)
+
+    return selected
+
+
+def format_document(index: int, document: Document, content: str) -> str:
+    metadata = ", ".join(
+        f"{key}: {document.metadata[key]}"
+        for key in _kept_metadata_keys
+        if key in document.metadata
+    )
+    header = f"[{index}] {metadata}" if metadata else f"[{index}]"
+    return f"{header}\n{content.strip()}"
+
+
+def pack_context(
+    documents: Sequence[Document],
+    max_tokens: int = DEFAULT_CONTEXT_TOKEN_BUDGET,
+) -> str:
+    """
+    検索結果を重複排除・スコア順に並べ替えて、トークン数の上限に収まる文脈の文字列にする
+    """
+    blocks: list[str] = []
+    remaining = max_tokens
+
+    for document in deduplicate(order_by_score(documents)):
+        block = format_document(len(blocks) + 1, document, document.page_content)
+        # ブロック間の区切り (空行) の分も数える
+        block_tokens = count_tokens(block) + (1 if blocks else 0)
+        if block_tokens <= remaining:
+            blocks.append(block)
+            remaining -= block_tokens
+            continue
+
+        # 入りきらないチャンクは、十分な余りがあれば切り詰めて入れる
+        header_tokens = count_tokens(format_document(len(blocks) + 1, document, ""))
+        content_budget = remaining - header_tokens - 1
+        if content_budget >= _min_truncated_tokens:
+            content = truncate_to_tokens(document.page_content.strip(), content_budget)
+            blocks.append(format_document(len(blocks) + 1, document, content))
+        break
+
+    return "\n\n".join(blocks)
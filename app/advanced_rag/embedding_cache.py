@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_EMBEDDING_CACHE_PATH = "./tmp/embedding_cache.sqlite3"
+
+_whitespace_pattern = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    # 全角・半角の揺れと空白の違いだけを吸収する (意味が変わる正規化はしない)
+    return _whitespace_pattern.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+@dataclass
+class EmbeddingCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    # キャッシュミス時にEmbedding APIの呼び出しにかかった合計時間
+    miss_seconds: float = 0.0
+    # キャッシュミス時にEmbedding APIに送った文字数
+    miss_characters: int = 0
+    # キャッシュヒットによって送らずに済んだ文字数
+    saved_characters: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def estimated_saved_seconds(self) -> float:
+        if self.misses == 0:
+            return 0.0
+        return self.hits * self.miss_seconds / self.misses
+
+
+class _DiskStore:
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # 複数プロセスから読み書きしても読み込みがブロックされないようにする
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT NOT NULL,"
+            " vector BLOB NOT NULL"
+            ")"
+        )
+        self._connection.commit()
+
+    def get(self, key: str) -> list[float] | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return array("f", row[0]).tolist()
+
+    def put(self, key: str, model: str, vector: list[float]) -> None:
+        blob = array("f", vector).tobytes()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)",
+                (key, model, blob),
+            )
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    クエリのEmbeddingをメモリ上のLRUとディスク (SQLite) の2段でキャッシュするEmbeddings
+
+    キーはEmbeddingモデル名と正規化したテキストから作る。
+    ドキュメントのEmbedding (インデックス作成時) はキャッシュせずにそのまま委譲する。
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        model_name: str,
+        db_path: str | None = DEFAULT_EMBEDDING_CACHE_PATH,
+        max_memory_entries: int = 10_000,
+    ):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.max_memory_entries = max_memory_entries
+        self.stats = EmbeddingCacheStats()
+        self._memory: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = _DiskStore(db_path) if db_path else None
+
+    def _key(self, text: str) -> str:
+        normalized = normalize_text(text)
+        return hashlib.sha256(f"{self.model_name}\0{normalized}".encode()).hexdigest()
+
+    def _lookup(self, key: str, text: str) -> list[float] | None:
+        embedding = self._lookup_memory(key, text)
+        if embedding is not None:
+            return embedding
+        return self._lookup_disk(key, text)
+
+    def _lookup_memory(self, key: str, text: str) -> list[float] | None:
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                self.stats.saved_characters += len(text)
+            return embedding
+
+    def _lookup_disk(self, key: str, text: str) -> list[float] | None:
+        if self._disk is None:
+            return None
+
+        embedding = self._disk.get(key)
+        if embedding is not None:
+            with self._lock:
+                self.stats.disk_hits += 1
+                self.stats.saved_characters += len(text)
+            self._remember(key, embedding)
+        return embedding
+
+    def _remember(self, key: str, embedding: list[float]) -> None:
+        with self._lock:
+            self._memory[key] = embedding
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _store(self, key: str, text: str, embedding: list[float], elapsed: float):
+        with self._lock:
+            self.stats.misses += 1
+            self.stats.miss_seconds += elapsed
+            self.stats.miss_characters += len(text)
+        self._remember(key, embedding)
+        if self._disk is not None:
+            self._disk.put(key, self.model_name, embedding)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        embedding = self._lookup(key, text)
+        if embedding is not None:
+            return embedding
+
+        start = time.perf_counter()
+        embedding = self.underlying.embed_query(text)
+        self._store(key, text, embedding, time.perf_counter() - start)
+        return embedding
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self._key(text)
+        # メモリ上のLRUはその場で引き、SQLiteの読み書きはイベントループを止めないようにスレッドで行う
+        embedding = self._lookup_memory(key, text)
+        if embedding is None and self._disk is not None:
+            embedding = await asyncio.to_thread(self._lookup_disk, key, text)
+        if embedding is not None:
+            return embedding
+
+        start = time.perf_counter()
+        embedding = await self.underlying.aembed_query(text)
+        await asyncio.to_thread(
+            self._store, key, text, embedding, time.perf_counter() - start
+        )
+        return embedding
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.underlying.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.underlying.aembed_documents(texts)
@@ -1,33 +1,136 @@
-from typing import Callable
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable
 
 from langchain_core.language_models import BaseChatModel
+from langchain_core.vectorstores import VectorStore
 
 from app.advanced_rag.chains.base import BaseRAGChain
+from app.advanced_rag.chains.hybrid import create_hybrid_rag_chain
+from app.advanced_rag.chains.hyde import create_hyde_rag_chain
+from app.advanced_rag.chains.multi_query import create_multi_query_rag_chain
 from app.advanced_rag.chains.naive import create_naive_rag_chain
+from app.advanced_rag.chains.rag_fusion import create_rag_fusion_chain
+from app.advanced_rag.chains.rerank import create_rerank_rag_chain
+from app.advanced_rag.chains.route import create_route_rag_chain
+from app.advanced_rag.chains.semantic_cache import (
+    create_semantic_cache_naive_rag_chain,
+)
+from app.advanced_rag.resources import (
+    DEFAULT_VECTOR_STORE_BACKEND,
+    VectorStoreBackend,
+    get_vector_store_for_backend,
+)
 
-# from app.advanced_rag.chains.hyde import create_hyde_rag_chain
-# from app.advanced_rag.chains.multi_query import create_multi_query_rag_chain
-# from app.advanced_rag.chains.rag_fusion import create_rag_fusion_chain
-# from app.advanced_rag.chains.rerank import create_rerank_rag_chain
-# from app.advanced_rag.chains.route import create_route_rag_chain
-# from app.advanced_rag.chains.hybrid import create_hybrid_rag_chain
-
-ChainConstructorType = Callable[[BaseChatModel], BaseRAGChain]
+ChainConstructorType = Callable[[BaseChatModel, VectorStore], BaseRAGChain]
 
 chain_constructor_by_name: dict[str, ChainConstructorType] = {
     "naive": create_naive_rag_chain,
-    # "hyde": create_hyde_rag_chain,
-    # "multi_query": create_multi_query_rag_chain,
-    # "rag_fusion": create_rag_fusion_chain,
-    # "rerank": create_rerank_rag_chain,
-    # "route": create_route_rag_chain,
-    # "hybrid": create_hybrid_rag_chain,
+    "hyde": create_hyde_rag_chain,
+    "multi_query": create_multi_query_rag_chain,
+    "rag_fusion": create_rag_fusion_chain,
+    "rerank": create_rerank_rag_chain,
+    "route": create_route_rag_chain,
+    "hybrid": create_hybrid_rag_chain,
+    "semantic_cache": create_semantic_cache_naive_rag_chain,
 }
 
 
-def create_rag_chain(chain_name: str, model: BaseChatModel) -> BaseRAGChain:
+def create_rag_chain(
+    chain_name: str,
+    model: BaseChatModel,
+    backend: VectorStoreBackend = DEFAULT_VECTOR_STORE_BACKEND,
+) -> BaseRAGChain:
     if chain_name not in chain_constructor_by_name:
         raise ValueError(f"Unknown chain name: {chain_name}")
 
     chain_constructor = chain_constructor_by_name[chain_name]
-    return chain_constructor(model)
+    return chain_constructor(model, get_vector_store_for_backend(backend))
+
+
+class RAGChainRegistry:
+    """
+    (チェーン名, モデルの設定, ベクトルストア) の組ごとにチェーンを1度だけ生成し、プロセス内で共有するレジストリ
+
+    モデルはインスタンスではなく設定 (モデル名やパラメーター) で識別するため、
+    リクエストごとに作ったモデルでも同じ設定なら生成済みのチェーンを使い回す。
+    保持するチェーンは最近使った max_chains 個までとする。
+
+    チェーンは複数のリクエストから同時に利用されるため、
+    stream の中でインスタンスの状態を書き換えないこと。
+    """
+
+    def __init__(self, max_chains: int = 32) -> None:
+        self.max_chains = max_chains
+        self._lock = threading.Lock()
+        self._chains: OrderedDict[tuple[str, str, str], BaseRAGChain] = OrderedDict()
+        self._build_locks: dict[tuple[str, str, str], threading.Lock] = {}
+
+    def get(
+        self,
+        chain_name: str,
+        model: BaseChatModel,
+        backend: VectorStoreBackend = DEFAULT_VECTOR_STORE_BACKEND,
+    ) -> BaseRAGChain:
+        if chain_name not in chain_constructor_by_name:
+            raise ValueError(f"Unknown chain name: {chain_name}")
+
+        # LLMのキャッシュと同じく、シリアライズした設定 (APIキーは含まない) をキーにする
+        key = (chain_name, model._get_llm_string(), backend)
+        with self._lock:
+            chain = self._chains.get(key)
+            if chain is not None:
+                self._chains.move_to_end(key)
+                return chain
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        # 生成中は同じキーのリクエストだけを待たせ、他のチェーンの取得は妨げない
+        with build_lock:
+            with self._lock:
+                chain = self._chains.get(key)
+                if chain is not None:
+                    self._chains.move_to_end(key)
+                    return chain
+
+            chain = create_rag_chain(chain_name, model, backend)
+
+            with self._lock:
+                self._chains[key] = chain
+                self._build_locks.pop(key, None)
+                while len(self._chains) > self.max_chains:
+                    self._chains.popitem(last=False)
+            return chain
+
+    def warm_up(
+        self,
+        chain_names: Iterable[str],
+        model: BaseChatModel,
+        backend: VectorStoreBackend = DEFAULT_VECTOR_STORE_BACKEND,
+    ) -> None:
+        for chain_name in chain_names:
+            self.get(chain_name, model, backend)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._chains.clear()
+
+
+rag_chain_registry = RAGChainRegistry()
+
+
+def get_rag_chain(
+    chain_name: str,
+    model: BaseChatModel,
+    backend: VectorStoreBackend = DEFAULT_VECTOR_STORE_BACKEND,
+) -> BaseRAGChain:
+    return rag_chain_registry.get(chain_name, model, backend)
+
+
+def warm_up_rag_chains(
+    model: BaseChatModel,
+    chain_names: Iterable[str] | None = None,
+    backend: VectorStoreBackend = DEFAULT_VECTOR_STORE_BACKEND,
+) -> None:
+    if chain_names is None:
+        chain_names = chain_constructor_by_name.keys()
+    rag_chain_registry.warm_up(chain_names, model, backend)
@@ -0,0 +1,374 @@
+"""
+メモリマップで読み込むFAISSのベクトルストア
+
+インデックスは読み込み専用でメモリマップするため、同じファイルを開いた複数のワーカープロセスは
+ページキャッシュ上のベクトルを共有する。本文とメタデータはSQLiteに置き、検索結果の分だけ読み込む。
+
+インデックスの作成方法 (Chromaに取り込み済みのEmbeddingをそのまま使う):
+    uv run python -m app.advanced_rag.faiss_store --index-type hnsw
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Iterable, Literal, Sequence
+
+import faiss
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+DEFAULT_FAISS_INDEX_DIRECTORY = "./tmp/faiss"
+
+FaissIndexType = Literal["flat", "ivf", "hnsw"]
+
+_index_file_name = "index.faiss"
+_docstore_file_name = "docstore.sqlite3"
+_meta_file_name = "meta.json"
+
+# ゼロコピーのメモリマップに対応したFAISSではそちらを使う
+_mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+
+class _DocStore:
+    def __init__(self, path: str, read_only: bool = True):
+        uri = f"file:{path}?mode=ro" if read_only else f"file:{path}?mode=rwc"
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        if not read_only:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " row INTEGER PRIMARY KEY,"
+                " id TEXT NOT NULL,"
+                " content TEXT NOT NULL,"
+                " metadata TEXT NOT NULL"
+                ")"
+            )
+            self._connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS documents_id ON documents (id)"
+            )
+
+    def insert(
+        self,
+        start_row: int,
+        ids: Sequence[str],
+        contents: Sequence[str],
+        metadatas: Sequence[dict[str, Any]],
+    ) -> None:
+        with self._lock:
+            self._connection.executemany(
+                "INSERT INTO documents (row, id, content, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (start_row + i, doc_id, content, json.dumps(metadata or {}))
+                    for i, (doc_id, content, metadata) in enumerate(
+                        zip(ids, contents, metadatas)
+                    )
+                ],
+            )
+            self._connection.commit()
+
+    def _fetch(self, column: str, values: Sequence[Any]) -> dict[Any, Document]:
+        placeholders = ", ".join("?" for _ in values)
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT row, id, content, metadata FROM documents"
+                f" WHERE {column} IN ({placeholders})",
+                list(values),
+            ).fetchall()
+        return {
+            (row if column == "row" else doc_id): Document(
+                id=doc_id, page_content=content, metadata=json.loads(metadata)
+            )
+            for row, doc_id, content, metadata in rows
+        }
+
+    def get_by_rows(self, rows: Sequence[int]) -> dict[int, Document]:
+        return self._fetch("row", rows) if rows else {}
+
+    def get_by_ids(self, ids: Sequence[str]) -> dict[str, Document]:
+        return self._fetch("id", ids) if ids else {}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class FaissVectorStore(VectorStore):
+    def __init__(
+        self,
+        index: faiss.Index,
+        docstore: _DocStore,
+        embedding: Embeddings,
+    ):
+        self.index = index
+        self.docstore = docstore
+        self._embedding = embedding
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    @classmethod
+    def load(
+        cls,
+        directory: str,
+        embedding: Embeddings,
+        mmap: bool = True,
+        nprobe: int = 16,
+        ef_search: int = 64,
+    ) -> "FaissVectorStore":
+        flags = (_mmap_flag | faiss.IO_FLAG_READ_ONLY) if mmap else 0
+        index = faiss.read_index(os.path.join(directory, _index_file_name), flags)
+        # 検索時の精度と速度のトレードオフはロード時に設定する
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = nprobe
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = ef_search
+        docstore = _DocStore(os.path.join(directory, _docstore_file_name))
+        return cls(index=index, docstore=docstore, embedding=embedding)
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, _meta_file_name))
+
+    @staticmethod
+    def read_meta(directory: str) -> dict[str, Any]:
+        with open(os.path.join(directory, _meta_file_name), encoding="utf-8") as file:
+            return json.load(file)
+
+    @staticmethod
+    def version(directory: str) -> tuple[int, ...]:
+        # 作り直すとメタデータのファイルが最後に書き換わるので、その更新時刻とサイズを版とみなす
+        try:
+            stat = os.stat(os.path.join(directory, _meta_file_name))
+        except FileNotFoundError:
+            return (0, 0)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _to_query_vector(self, embedding: list[float]) -> np.ndarray:
+        vector = np.asarray([embedding], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: list[float], k: int = 4
+    ) -> list[tuple[Document, float]]:
+        scores, rows = self.index.search(self._to_query_vector(embedding), k)
+        hits = [(int(row), float(score)) for row, score in zip(rows[0], scores[0])]
+        hits = [(row, score) for row, score in hits if row >= 0]
+        documents = self.docstore.get_by_rows([row for row, _ in hits])
+        return [(documents[row], score) for row, score in hits if row in documents]
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        return [
+            document
+            for document, _ in self.similarity_search_with_score_by_vector(embedding, k)
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        embedding = self._embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k)
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        embedding = self._embedding.embed_query(query)
+        return self.similarity_search_by_vector(embedding, k)
+
+    def _select_relevance_score_fn(self):  # type: ignore[no-untyped-def]
+        # 正規化したベクトルの内積 (コサイン類似度) を [0, 1] に変換する
+        return lambda score: (score + 1.0) / 2.0
+
+    def get_by_ids(self, ids: Sequence[str], /) -> list[Document]:
+        documents = self.docstore.get_by_ids(ids)
+        return [documents[doc_id] for doc_id in ids if doc_id in documents]
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] | None = None,
+        *,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        """
+        インデックスは読み込み専用のため、テキストは追加できない (常に TypeError を送出する)
+
+        ドキュメントを増やすときは、Chromaに取り込んでから build_faiss_index_from_chroma で
+        インデックスを作り直す。
+        """
+        raise TypeError(
+            "FaissVectorStore is read-only and does not support add_texts. "
+            "Ingest the documents into Chroma and rebuild the index with "
+            "build_faiss_index_from_chroma "
+            "(uv run python -m app.advanced_rag.faiss_store)."
+        )
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        *,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> "FaissVectorStore":
+        directory = kwargs.pop("directory", DEFAULT_FAISS_INDEX_DIRECTORY)
+        index_type = kwargs.pop("index_type", "flat")
+        vectors = np.asarray(embedding.embed_documents(texts), dtype=np.float32)
+        build_faiss_index(
+            directory=directory,
+            vectors=vectors,
+            ids=ids or [str(i) for i in range(len(texts))],
+            contents=texts,
+            metadatas=metadatas or [{} for _ in texts],
+            index_type=index_type,
+        )
+        return cls.load(directory, embedding)
+
+
+def _create_index(
+    index_type: FaissIndexType, dimension: int, n_vectors: int, hnsw_m: int
+) -> faiss.Index:
+    # ベクトルは正規化して内積で検索する (コサイン類似度)
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dimension)
+    if index_type == "ivf":
+        # クラスタ数はベクトル数の平方根程度にする
+        nlist = max(1, min(int(np.sqrt(n_vectors)), n_vectors // 39 or 1))
+        quantizer = faiss.IndexFlatIP(dimension)
+        return faiss.IndexIVFFlat(
+            quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT
+        )
+    if index_type == "hnsw":
+        return faiss.IndexHNSWFlat(dimension, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+def build_faiss_index(
+    directory: str,
+    vectors: np.ndarray,
+    ids: Sequence[str],
+    contents: Sequence[str],
+    metadatas: Sequence[dict[str, Any]],
+    index_type: FaissIndexType = "hnsw",
+    hnsw_m: int = 32,
+) -> None:
+    os.makedirs(directory, exist_ok=True)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+
+    index = _create_index(index_type, vectors.shape[1], len(vectors), hnsw_m)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+
+    # 作り直す場合に古いファイルと混ざらないよう、一時ファイルに書いてから置き換える
+    index_path = os.path.join(directory, _index_file_name)
+    faiss.write_index(index, f"{index_path}.tmp")
+    docstore_path = os.path.join(directory, _docstore_file_name)
+    if os.path.exists(f"{docstore_path}.tmp"):
+        os.remove(f"{docstore_path}.tmp")
+    docstore = _DocStore(f"{docstore_path}.tmp", read_only=False)
+    docstore.insert(0, ids, contents, metadatas)
+    docstore.close()
+
+    os.replace(f"{index_path}.tmp", index_path)
+    os.replace(f"{docstore_path}.tmp", docstore_path)
+    with open(os.path.join(directory, _meta_file_name), "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "index_type": index_type,
+                "dimension": int(vectors.shape[1]),
+                "count": len(vectors),
+            },
+            file,
+        )
+
+
+def build_faiss_index_from_chroma(
+    vector_store: Chroma,
+    directory: str = DEFAULT_FAISS_INDEX_DIRECTORY,
+    index_type: FaissIndexType = "hnsw",
+    page_size: int = 5000,
+) -> int:
+    ids: list[str] = []
+    contents: list[str] = []
+    metadatas: list[dict[str, Any]] = []
+    vectors: list[np.ndarray] = []
+    offset = 0
+    while True:
+        page = vector_store.get(
+            include=["documents", "metadatas", "embeddings"],
+            limit=page_size,
+            offset=offset,
+        )
+        if not page["ids"]:
+            break
+        ids.extend(page["ids"])
+        contents.extend(page["documents"])
+        metadatas.extend(metadata or {} for metadata in page["metadatas"])
+        vectors.append(np.asarray(page["embeddings"], dtype=np.float32))
+        offset += len(page["ids"])
+
+    if not ids:
+        raise ValueError("Chroma collection is empty")
+
+    build_faiss_index(
+        directory=directory,
+        vectors=np.concatenate(vectors),
+        ids=ids,
+        contents=contents,
+        metadatas=metadatas,
+        index_type=index_type,
+    )
+    return len(ids)
+
+
+def main():
+    import argparse
+    import time
+
+    from dotenv import load_dotenv
+
+    from app.advanced_rag.resources import (
+        DEFAULT_CHROMA_PERSIST_DIRECTORY,
+        get_vector_store,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="ChromaのEmbeddingからFAISSのインデックスを作成します"
+    )
+    parser.add_argument(
+        "--persist-dir", type=str, default=DEFAULT_CHROMA_PERSIST_DIRECTORY
+    )
+    parser.add_argument("--index-dir", type=str, default=DEFAULT_FAISS_INDEX_DIRECTORY)
+    parser.add_argument(
+        "--index-type", type=str, choices=["flat", "ivf", "hnsw"], default="hnsw"
+    )
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+
+    start = time.perf_counter()
+    vector_store = get_vector_store(args.persist_dir)
+    assert isinstance(vector_store, Chroma)
+    count = build_faiss_index_from_chroma(
+        vector_store, directory=args.index_dir, index_type=args.index_type
+    )
+    print(
+        f"indexed {count} chunks ({args.index_type}) "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
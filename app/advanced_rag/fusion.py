@@ -0,0 +1,27 @@
+from typing import Sequence
+
+from langchain_core.documents import Document
+
+
+def _document_key(document: Document) -> str:
+    return document.id or document.page_content
+
+
+def reciprocal_rank_fusion(
+    result_lists: Sequence[Sequence[Document]],
+    k: int = 60,
+    top_n: int | None = None,
+) -> list[Document]:
+    # 各検索結果の順位rに対して 1 / (k + r) を足し合わせ、合計の大きい順に並べる
+    scores: dict[str, float] = {}
+    documents: dict[str, Document] = {}
+    for results in result_lists:
+        for rank, document in enumerate(results):
+            key = _document_key(document)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+
+    ranked_keys = sorted(scores, key=lambda key: scores[key], reverse=True)
+    if top_n is not None:
+        ranked_keys = ranked_keys[:top_n]
+    return [documents[key] for key in ranked_keys]
@@ -0,0 +1,50 @@
+from contextlib import aclosing, closing
+from typing import AsyncGenerator, Generator
+
+from langchain_core.language_models import BaseChatModel
+
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.chains.base import AnswerToken
+from app.advanced_rag.metrics import StageTimer
+
+
+def stream_answer(
+    model: BaseChatModel,
+    prompt: str,
+    timer: StageTimer,
+    cancellation: CancellationToken | None = None,
+) -> Generator[AnswerToken, None, None]:
+    cancellation = cancellation or CancellationToken()
+    cancellation.check()
+
+    # 次のチャンクを待つ間も期限を過ぎたら打ち切る
+    # (このジェネレーターが閉じられたり中断されたりしたら、上流のストリームも閉じて接続を解放する)
+    with (
+        timer.measure("generation"),
+        closing(cancellation.iterate(model.stream(prompt))) as chunks,
+    ):
+        for chunk in chunks:
+            timer.mark("time_to_first_token")
+            yield AnswerToken(token=chunk.content)
+
+
+async def astream_answer(
+    model: BaseChatModel,
+    prompt: str,
+    timer: StageTimer,
+    cancellation: CancellationToken | None = None,
+) -> AsyncGenerator[AnswerToken, None]:
+    cancellation = cancellation or CancellationToken()
+    cancellation.check()
+
+    with timer.measure("generation"):
+        async with aclosing(model.astream(prompt)) as chunks:
+            # 次のチャンクを待つ間も期限を過ぎたら打ち切る
+            iterator = aiter(chunks)
+            while True:
+                try:
+                    chunk = await cancellation.run(anext(iterator))
+                except StopAsyncIteration:
+                    break
+                timer.mark("time_to_first_token")
+                yield AnswerToken(token=chunk.content)
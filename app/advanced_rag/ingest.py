@@ -0,0 +1,304 @@
+"""
+tmp/langchain-docs 以下のドキュメントをChromaに取り込むコマンド
+
+変更のあったファイルだけを再度Embeddingし、削除されたファイルのチャンクはChromaからも削除する。
+Chromaから作ったBM25とFAISSのインデックスがあれば、変更があった場合に作り直す。
+
+実行方法:
+    uv run python -m app.advanced_rag.ingest
+"""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from glob import glob
+from typing import Any
+
+from langchain_chroma import Chroma
+from langchain_text_splitters import MarkdownTextSplitter
+
+from app.advanced_rag.bm25 import (
+    DEFAULT_BM25_INDEX_DIRECTORY,
+    BM25Index,
+    build_bm25_index_from_chroma,
+)
+from app.advanced_rag.faiss_store import (
+    DEFAULT_FAISS_INDEX_DIRECTORY,
+    FaissVectorStore,
+    build_faiss_index_from_chroma,
+)
+from app.advanced_rag.resources import (
+    DEFAULT_CHROMA_PERSIST_DIRECTORY,
+    DEFAULT_EMBEDDING_MODEL,
+    get_vector_store,
+)
+
+DEFAULT_SOURCE_DIRECTORY = "tmp/langchain-docs"
+DEFAULT_GLOB_PATTERN = "**/*.mdx"
+_manifest_file_name = "ingest_manifest.json"
+_manifest_version = 1
+
+
+@dataclass
+class FileChunks:
+    path: str
+    sha256: str
+    # 内容が変わっていないファイルは分割しない (None)
+    chunks: list[str] | None
+
+
+@dataclass
+class IngestResult:
+    added_files: list[str] = field(default_factory=list)
+    updated_files: list[str] = field(default_factory=list)
+    removed_files: list[str] = field(default_factory=list)
+    unchanged_files: int = 0
+    embedded_chunks: int = 0
+    deleted_chunks: int = 0
+    rebuilt_indexes: list[str] = field(default_factory=list)
+    elapsed_seconds: float = 0.0
+
+
+def _chunk_id(path: str, index: int) -> str:
+    return f"{path}#{index}"
+
+
+def _load_and_split(
+    path: str, known_sha256: str | None, chunk_size: int, chunk_overlap: int
+) -> FileChunks:
+    # プロセスプールのワーカーで実行される
+    with open(path, "rb") as file:
+        content = file.read()
+    sha256 = hashlib.sha256(content).hexdigest()
+    if sha256 == known_sha256:
+        return FileChunks(path=path, sha256=sha256, chunks=None)
+
+    splitter = MarkdownTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    text = content.decode("utf-8", errors="replace")
+    return FileChunks(path=path, sha256=sha256, chunks=splitter.split_text(text))
+
+
+def _find_chunk_ids(
+    vector_store: Chroma, sources: list[str], batch_size: int
+) -> list[str]:
+    ids: list[str] = []
+    for i in range(0, len(sources), batch_size):
+        page = vector_store.get(
+            where={"source": {"$in": sources[i : i + batch_size]}}, include=[]
+        )
+        ids.extend(page["ids"])
+    return ids
+
+
+def _load_manifest(path: str) -> dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _save_manifest(path: str, manifest: dict[str, Any]) -> None:
+    # 書き込み途中で中断しても壊れないよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def ingest(
+    source_directory: str = DEFAULT_SOURCE_DIRECTORY,
+    glob_pattern: str = DEFAULT_GLOB_PATTERN,
+    persist_directory: str = DEFAULT_CHROMA_PERSIST_DIRECTORY,
+    embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+    chunk_size: int = 1000,
+    chunk_overlap: int = 200,
+    batch_size: int = 512,
+    max_workers: int | None = None,
+    max_embedding_concurrency: int = 4,
+    bm25_index_directory: str = DEFAULT_BM25_INDEX_DIRECTORY,
+    faiss_index_directory: str = DEFAULT_FAISS_INDEX_DIRECTORY,
+) -> IngestResult:
+    start = time.perf_counter()
+    result = IngestResult()
+
+    vector_store = get_vector_store(persist_directory, embedding_model)
+    assert isinstance(vector_store, Chroma)
+
+    os.makedirs(persist_directory, exist_ok=True)
+    manifest_path = os.path.join(persist_directory, _manifest_file_name)
+    manifest = _load_manifest(manifest_path)
+    settings = {
+        "version": _manifest_version,
+        "embedding_model": embedding_model,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+    }
+    # 分割やEmbeddingの設定が変わった場合はすべてのファイルを取り込み直す
+    known_files: dict[str, dict[str, Any]] = manifest.get("files", {})
+    settings_changed = manifest.get("settings") != settings
+
+    paths = sorted(glob(os.path.join(source_directory, glob_pattern), recursive=True))
+
+    # ファイルの読み込みとハッシュ計算、チャンク分割はプロセスプールで並列に行う
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _load_and_split,
+                path,
+                None if settings_changed else known_files.get(path, {}).get("sha256"),
+                chunk_size,
+                chunk_overlap,
+            )
+            for path in paths
+        ]
+        file_chunks_list = [future.result() for future in futures]
+
+    # 新しいチャンクをまとめてEmbeddingし、バッチ単位でChromaに書き込む
+    ids: list[str] = []
+    texts: list[str] = []
+    metadatas: list[dict[str, Any]] = []
+    new_files: dict[str, dict[str, Any]] = {}
+    for file_chunks in file_chunks_list:
+        if file_chunks.chunks is None:
+            result.unchanged_files += 1
+            new_files[file_chunks.path] = known_files[file_chunks.path]
+            continue
+
+        if file_chunks.path in known_files:
+            result.updated_files.append(file_chunks.path)
+        else:
+            result.added_files.append(file_chunks.path)
+
+        chunk_ids = [
+            _chunk_id(file_chunks.path, i) for i in range(len(file_chunks.chunks))
+        ]
+        ids.extend(chunk_ids)
+        texts.extend(file_chunks.chunks)
+        metadatas.extend({"source": file_chunks.path} for _ in file_chunks.chunks)
+        new_files[file_chunks.path] = {
+            "sha256": file_chunks.sha256,
+            "chunk_ids": chunk_ids,
+        }
+
+    batches = [
+        (
+            ids[i : i + batch_size],
+            texts[i : i + batch_size],
+            metadatas[i : i + batch_size],
+        )
+        for i in range(0, len(ids), batch_size)
+    ]
+
+    def embed_batch(batch: tuple[list[str], list[str], list[dict[str, Any]]]) -> None:
+        batch_ids, batch_texts, batch_metadatas = batch
+        # チャンクIDは決定的なので、途中で中断して再実行しても重複しない (add_texts は upsert する)
+        vector_store.add_texts(batch_texts, metadatas=batch_metadatas, ids=batch_ids)
+
+    # Embedding APIの待ち時間を重ねるため、バッチはスレッドで並行に処理する
+    with ThreadPoolExecutor(max_workers=max_embedding_concurrency) as executor:
+        for _ in executor.map(embed_batch, batches):
+            pass
+    result.embedded_chunks = len(ids)
+
+    # 新しいチャンクを書き込めてから、削除・変更されたファイルの古いチャンクを削除する
+    # (Embeddingに失敗した場合は古いチャンクが残る)。マニフェストにないチャンク
+    # (以前にランダムなIDで取り込んだもの) も拾えるよう、ソースのパスで検索する。
+    # ソースはこのコマンドが付けるパスと、取り込み元のディレクトリからの相対パスの両方で探す
+    current_paths = set(paths)
+    result.removed_files = [path for path in known_files if path not in current_paths]
+    changed_paths = result.removed_files + result.added_files + result.updated_files
+    sources = list(
+        dict.fromkeys(
+            source
+            for path in changed_paths
+            for source in (path, os.path.relpath(path, source_directory))
+        )
+    )
+    new_ids = set(ids)
+    stale_ids = [
+        chunk_id
+        for chunk_id in _find_chunk_ids(vector_store, sources, batch_size)
+        if chunk_id not in new_ids
+    ]
+    for i in range(0, len(stale_ids), batch_size):
+        vector_store.delete(ids=stale_ids[i : i + batch_size])
+    result.deleted_chunks = len(stale_ids)
+
+    _save_manifest(manifest_path, {"settings": settings, "files": new_files})
+
+    # Chromaから作ったインデックスは、古い内容のまま検索されないよう作り直す
+    if changed_paths or stale_ids:
+        if BM25Index.exists(bm25_index_directory):
+            build_bm25_index_from_chroma(vector_store).save(bm25_index_directory)
+            result.rebuilt_indexes.append(bm25_index_directory)
+        if FaissVectorStore.exists(faiss_index_directory):
+            # インデックスの種類は作り直す前のものを引き継ぐ
+            build_faiss_index_from_chroma(
+                vector_store,
+                directory=faiss_index_directory,
+                index_type=FaissVectorStore.read_meta(faiss_index_directory).get(
+                    "index_type", "hnsw"
+                ),
+            )
+            result.rebuilt_indexes.append(faiss_index_directory)
+
+    result.elapsed_seconds = time.perf_counter() - start
+    return result
+
+
+def main():
+    import argparse
+
+    from dotenv import load_dotenv
+
+    load_dotenv(override=True)
+
+    parser = argparse.ArgumentParser(
+        description="ドキュメントを差分だけChromaに取り込みます"
+    )
+    parser.add_argument("--source-dir", type=str, default=DEFAULT_SOURCE_DIRECTORY)
+    parser.add_argument("--glob", type=str, default=DEFAULT_GLOB_PATTERN)
+    parser.add_argument(
+        "--persist-dir", type=str, default=DEFAULT_CHROMA_PERSIST_DIRECTORY
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument(
+        "--workers", type=int, default=None, help="分割に使うプロセス数"
+    )
+    parser.add_argument(
+        "--embedding-concurrency",
+        type=int,
+        default=4,
+        help="同時に実行するEmbedding APIの呼び出し数",
+    )
+    args = parser.parse_args()
+
+    result = ingest(
+        source_directory=args.source_dir,
+        glob_pattern=args.glob,
+        persist_directory=args.persist_dir,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        batch_size=args.batch_size,
+        max_workers=args.workers,
+        max_embedding_concurrency=args.embedding_concurrency,
+    )
+
+    print(f"added files: {len(result.added_files)}")
+    print(f"updated files: {len(result.updated_files)}")
+    print(f"removed files: {len(result.removed_files)}")
+    print(f"unchanged files: {result.unchanged_files}")
+    print(f"embedded chunks: {result.embedded_chunks}")
+    print(f"deleted chunks: {result.deleted_chunks}")
+    for directory in result.rebuilt_indexes:
+        print(f"rebuilt index: {directory}")
+    print(f"elapsed: {result.elapsed_seconds:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
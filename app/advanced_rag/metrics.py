@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np
+
+from app.advanced_rag.chains.base import Metrics
+
+
+class LatencyRecorder:
+    """
+    チェーン・ステージごとに直近 window 件の所要時間を保持し、パーセンタイルを計算する
+    """
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: dict[tuple[str, str], deque[float]] = {}
+
+    def record(self, chain_name: str, timings: dict[str, float]) -> None:
+        with self._lock:
+            for stage, seconds in timings.items():
+                key = (chain_name, stage)
+                samples = self._samples.get(key)
+                if samples is None:
+                    samples = self._samples[key] = deque(maxlen=self.window)
+                samples.append(seconds)
+
+    def percentiles(
+        self, percentiles: tuple[float, ...] = (50, 95)
+    ) -> dict[tuple[str, str], dict[str, float]]:
+        with self._lock:
+            snapshot = {key: list(samples) for key, samples in self._samples.items()}
+        return {
+            key: {
+                f"p{p:g}": float(value)
+                for p, value in zip(percentiles, np.percentile(samples, percentiles))
+            }
+            for key, samples in snapshot.items()
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._samples.clear()
+
+
+latency_recorder = LatencyRecorder()
+
+
+class StageTimer:
+    """
+    1回の stream の中で、ステージごとの所要時間を計測する
+
+    並行して実行するステージ (複数クエリの検索など) は所要時間を合計する。
+    """
+
+    def __init__(self, chain_name: str):
+        self.chain_name = chain_name
+        self.start = time.perf_counter()
+        self.timings: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def mark(self, stage: str) -> None:
+        # stream の開始からの経過時間を記録する (最初の1回だけ)
+        with self._lock:
+            if stage not in self.timings:
+                self.timings[stage] = time.perf_counter() - self.start
+
+    def finish(self) -> Metrics:
+        with self._lock:
+            self.timings["total"] = time.perf_counter() - self.start
+            timings = dict(self.timings)
+        latency_recorder.record(self.chain_name, timings)
+        return Metrics(timings=timings)
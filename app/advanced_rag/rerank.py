@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import math
+import os
+import threading
+from collections import Counter, OrderedDict
+from typing import Protocol, Sequence
+
+from langchain_core.documents import Document
+
+from app.advanced_rag.bm25 import tokenize
+from app.advanced_rag.embedding_cache import normalize_text
+
+
+class Scorer(Protocol):
+    def score(self, query: str, texts: Sequence[str]) -> list[float]:
+        """
+        クエリと各テキストの関連度を1回の呼び出しでまとめて計算する
+        """
+        ...
+
+
+class TokenOverlapScorer:
+    """
+    クエリの用語がテキストにどれだけ含まれるかで関連度を計算する、オフラインで動くスコアラー
+
+    スコアはクエリとテキストの組だけで決まるため、キャッシュできる。
+    """
+
+    def score(self, query: str, texts: Sequence[str]) -> list[float]:
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return [0.0] * len(texts)
+        # 長い用語 (英単語) ほど、一致したときの重みを大きくする
+        weights = {term: math.log(1.0 + len(term)) for term in query_terms}
+        total_weight = sum(weights.values())
+
+        scores = []
+        for text in texts:
+            counts = Counter(tokenize(text))
+            matched = sum(
+                weights[term] * (1.0 + math.log(counts[term]))
+                for term in query_terms
+                if counts[term]
+            )
+            scores.append(matched / total_weight)
+        return scores
+
+
+class CohereScorer:
+    def __init__(self, model: str = "rerank-v3.5"):
+        # Cohereはオプションのプラグインなので、使う場合だけ読み込む
+        import cohere
+
+        self.model = model
+        self.client = cohere.ClientV2(api_key=os.environ.get("COHERE_API_KEY"))
+
+    def score(self, query: str, texts: Sequence[str]) -> list[float]:
+        response = self.client.rerank(
+            model=self.model, query=query, documents=list(texts), top_n=len(texts)
+        )
+        scores = [0.0] * len(texts)
+        for result in response.results:
+            scores[result.index] = result.relevance_score
+        return scores
+
+
+class Reranker:
+    """
+    検索結果をスコアラーで並べ替えて上位 top_k 件に絞る
+
+    スコアは (クエリ, ドキュメントのハッシュ) をキーにLRUでキャッシュし、
+    キャッシュにない候補だけをまとめて1回でスコアラーに渡す。
+
+    fuse_with_retrieval が真の場合は、スコアの順位と検索の順位をRRFで統合して並べる。
+    省略した場合は、TokenOverlapScorer のようなヒューリスティックのスコアラーでだけ統合する
+    (検索の順位を捨てると、並べ替えない場合より悪くなることがあるため)。
+    """
+
+    def __init__(
+        self,
+        scorer: Scorer | None = None,
+        top_k: int = 5,
+        max_candidates: int = 20,
+        cache_size: int = 10_000,
+        fuse_with_retrieval: bool | None = None,
+        rrf_k: int = 60,
+    ):
+        self.scorer = scorer or TokenOverlapScorer()
+        if fuse_with_retrieval is None:
+            fuse_with_retrieval = isinstance(self.scorer, TokenOverlapScorer)
+        self.fuse_with_retrieval = fuse_with_retrieval
+        self.rrf_k = rrf_k
+        self.top_k = top_k
+        self.max_candidates = max_candidates
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, query: str, document: Document) -> tuple[str, str]:
+        content_hash = hashlib.sha1(document.page_content.encode()).hexdigest()
+        return normalize_text(query), content_hash
+
+    def rerank(self, query: str, documents: Sequence[Document]) -> list[Document]:
+        # スコアを計算する前に、検索順位の下位の候補は打ち切る
+        candidates = list(documents[: self.max_candidates])
+        keys = [self._key(query, document) for document in candidates]
+
+        scores: dict[tuple[str, str], float] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[key] = self._cache[key]
+            self.cache_hits += len(scores)
+
+        missing = [
+            (key, document)
+            for key, document in zip(keys, candidates)
+            if key not in scores
+        ]
+        # 同じ内容のチャンクは1回だけスコアを計算する
+        missing = list({key: (key, document) for key, document in missing}.values())
+        if missing:
+            new_scores = self.scorer.score(
+                query, [document.page_content for _, document in missing]
+            )
+            with self._lock:
+                self.cache_misses += len(missing)
+                for (key, _), score in zip(missing, new_scores):
+                    scores[key] = score
+                    self._cache[key] = score
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        # スコアが同じ場合は検索順位を保つ
+        order = sorted(
+            range(len(candidates)), key=lambda i: scores[keys[i]], reverse=True
+        )
+        # relevance_score には並べ替えに使ったスコアを入れる
+        # (pack_context などが relevance_score で並べ直しても、この順序が保たれるように)
+        relevance = [scores[key] for key in keys]
+        if self.fuse_with_retrieval:
+            # スコアの順位は並べ替えた位置で決める (同じスコアの候補は検索順位の順になる)
+            score_rank = {i: rank for rank, i in enumerate(order)}
+            relevance = [
+                1.0 / (self.rrf_k + i + 1) + 1.0 / (self.rrf_k + score_rank[i] + 1)
+                for i in range(len(candidates))
+            ]
+            order = sorted(
+                range(len(candidates)), key=lambda i: relevance[i], reverse=True
+            )
+
+        return [
+            Document(
+                id=candidates[i].id,
+                page_content=candidates[i].page_content,
+                metadata={**candidates[i].metadata, "relevance_score": relevance[i]},
+            )
+            for i in order[: self.top_k]
+        ]
+
+    async def arerank(
+        self, query: str, documents: Sequence[Document]
+    ) -> list[Document]:
+        return await asyncio.to_thread(self.rerank, query, documents)
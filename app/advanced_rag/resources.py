@@ -0,0 +1,168 @@
+import os
+import threading
+from typing import Literal
+
+from langchain.embeddings import init_embeddings
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from app.advanced_rag.bm25 import (
+    DEFAULT_BM25_INDEX_DIRECTORY,
+    BM25Index,
+    build_bm25_index_from_chroma,
+)
+from app.advanced_rag.embedding_cache import (
+    DEFAULT_EMBEDDING_CACHE_PATH,
+    CachedEmbeddings,
+    EmbeddingCacheStats,
+)
+from app.advanced_rag.faiss_store import (
+    DEFAULT_FAISS_INDEX_DIRECTORY,
+    FaissVectorStore,
+    build_faiss_index_from_chroma,
+)
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+DEFAULT_CHROMA_PERSIST_DIRECTORY = "./tmp/chroma"
+
+VectorStoreBackend = Literal["chroma", "faiss"]
+DEFAULT_VECTOR_STORE_BACKEND: VectorStoreBackend = "chroma"
+
+# プロセス内で共有するEmbeddingsとベクトルストア
+# (生成はまれなので、ひとつのロックで直列化する)
+_lock = threading.RLock()
+_embeddings_by_model: dict[str, CachedEmbeddings] = {}
+_vector_store_by_key: dict[tuple[str, str], VectorStore] = {}
+_faiss_vector_store_by_key: dict[tuple[str, str], FaissVectorStore] = {}
+_bm25_index_by_directory: dict[str, BM25Index] = {}
+
+
+def get_embeddings(model: str = DEFAULT_EMBEDDING_MODEL) -> Embeddings:
+    with _lock:
+        embeddings = _embeddings_by_model.get(model)
+        if embeddings is None:
+            # 同じ質問が繰り返されることが多いため、クエリのEmbeddingはキャッシュする
+            embeddings = CachedEmbeddings(
+                underlying=init_embeddings(model=model, provider="openai"),
+                model_name=model,
+                db_path=DEFAULT_EMBEDDING_CACHE_PATH,
+            )
+            _embeddings_by_model[model] = embeddings
+        return embeddings
+
+
+def get_embedding_cache_stats() -> dict[str, EmbeddingCacheStats]:
+    with _lock:
+        return {
+            model: embeddings.stats
+            for model, embeddings in _embeddings_by_model.items()
+        }
+
+
+def get_vector_store(
+    persist_directory: str = DEFAULT_CHROMA_PERSIST_DIRECTORY,
+    embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+) -> VectorStore:
+    key = (persist_directory, embedding_model)
+    with _lock:
+        vector_store = _vector_store_by_key.get(key)
+        if vector_store is None:
+            vector_store = Chroma(
+                embedding_function=get_embeddings(embedding_model),
+                persist_directory=persist_directory,
+            )
+            _vector_store_by_key[key] = vector_store
+        return vector_store
+
+
+def get_faiss_vector_store(
+    index_directory: str = DEFAULT_FAISS_INDEX_DIRECTORY,
+    embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+) -> FaissVectorStore:
+    key = (index_directory, embedding_model)
+    with _lock:
+        vector_store = _faiss_vector_store_by_key.get(key)
+        if vector_store is None:
+            # 通常は `python -m app.advanced_rag.faiss_store` で事前に作成しておく
+            if not FaissVectorStore.exists(index_directory):
+                chroma = get_vector_store(embedding_model=embedding_model)
+                assert isinstance(chroma, Chroma)
+                build_faiss_index_from_chroma(chroma, directory=index_directory)
+            vector_store = FaissVectorStore.load(
+                index_directory, embedding=get_embeddings(embedding_model)
+            )
+            _faiss_vector_store_by_key[key] = vector_store
+        return vector_store
+
+
+def get_vector_store_for_backend(
+    backend: VectorStoreBackend = DEFAULT_VECTOR_STORE_BACKEND,
+) -> VectorStore:
+    if backend == "chroma":
+        return get_vector_store()
+    if backend == "faiss":
+        return get_faiss_vector_store()
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+
+def get_bm25_index(
+    index_directory: str = DEFAULT_BM25_INDEX_DIRECTORY,
+    persist_directory: str = DEFAULT_CHROMA_PERSIST_DIRECTORY,
+) -> BM25Index:
+    with _lock:
+        index = _bm25_index_by_directory.get(index_directory)
+        if index is None:
+            # 通常は `python -m app.advanced_rag.bm25` で事前に作成しておく
+            if not BM25Index.exists(index_directory):
+                vector_store = get_vector_store(persist_directory)
+                assert isinstance(vector_store, Chroma)
+                build_bm25_index_from_chroma(vector_store).save(index_directory)
+            index = BM25Index.load(index_directory)
+            _bm25_index_by_directory[index_directory] = index
+        return index
+
+
+def get_vector_store_version(
+    persist_directory: str = DEFAULT_CHROMA_PERSIST_DIRECTORY,
+) -> tuple[int, ...]:
+    # Chromaはコレクションの変更をSQLiteに書き込むので、そのファイルの更新時刻とサイズを版とみなす
+    version: list[int] = []
+    for file_name in ("chroma.sqlite3", "chroma.sqlite3-wal"):
+        try:
+            stat = os.stat(os.path.join(persist_directory, file_name))
+        except FileNotFoundError:
+            version.extend((0, 0))
+            continue
+        version.extend((stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+
+def get_faiss_index_version(
+    index_directory: str = DEFAULT_FAISS_INDEX_DIRECTORY,
+) -> tuple[int, ...]:
+    return FaissVectorStore.version(index_directory)
+
+
+def get_backend_of(vector_store: VectorStore) -> VectorStoreBackend:
+    return "faiss" if isinstance(vector_store, FaissVectorStore) else "chroma"
+
+
+def get_vector_store_version_for_backend(
+    backend: VectorStoreBackend = DEFAULT_VECTOR_STORE_BACKEND,
+    directory: str | None = None,
+) -> tuple[int, ...]:
+    # directory を省略した場合は、それぞれのデフォルトの保存先の版を返す
+    if backend == "chroma":
+        return get_vector_store_version(directory or DEFAULT_CHROMA_PERSIST_DIRECTORY)
+    if backend == "faiss":
+        return get_faiss_index_version(directory or DEFAULT_FAISS_INDEX_DIRECTORY)
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+
+def clear_resources() -> None:
+    with _lock:
+        _embeddings_by_model.clear()
+        _vector_store_by_key.clear()
+        _faiss_vector_store_by_key.clear()
+        _bm25_index_by_directory.clear()
@@ -0,0 +1,117 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
+from typing import Sequence
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStoreRetriever
+
+from app.advanced_rag.cancellation import CancellationToken
+from app.advanced_rag.metrics import StageTimer
+
+
+def _is_splittable(retriever: BaseRetriever) -> bool:
+    # Embeddingと近傍探索を分けて実行できるか
+    return (
+        isinstance(retriever, VectorStoreRetriever)
+        and retriever.search_type == "similarity"
+        and retriever.vectorstore.embeddings is not None
+    )
+
+
+def _measure(timer: StageTimer | None, stage: str) -> AbstractContextManager[None]:
+    return timer.measure(stage) if timer is not None else nullcontext()
+
+
+def retrieve(
+    retriever: BaseRetriever,
+    query: str,
+    timer: StageTimer | None = None,
+    cancellation: CancellationToken | None = None,
+) -> list[Document]:
+    cancellation = cancellation or CancellationToken()
+    cancellation.check()
+
+    if _is_splittable(retriever):
+        assert isinstance(retriever, VectorStoreRetriever)
+        # Embedding APIの応答を待つ間も期限を過ぎたら打ち切る
+        with _measure(timer, "embedding"):
+            embedding = cancellation.call(
+                retriever.vectorstore.embeddings.embed_query,  # type: ignore[union-attr]
+                query,
+            )
+        with _measure(timer, "vector_search"):
+            return retriever.vectorstore.similarity_search_by_vector(
+                embedding, **retriever.search_kwargs
+            )
+
+    with _measure(timer, "search"):
+        return cancellation.call(retriever.invoke, query)
+
+
+async def aretrieve(
+    retriever: BaseRetriever,
+    query: str,
+    timer: StageTimer | None = None,
+    cancellation: CancellationToken | None = None,
+) -> list[Document]:
+    cancellation = cancellation or CancellationToken()
+
+    # VectorStoreRetriever.ainvoke はEmbedding APIの呼び出しごとスレッドで実行するため、
+    # Embeddingだけは非同期クライアントで取得し、ローカルの近傍探索だけをスレッドに任せる
+    if _is_splittable(retriever):
+        assert isinstance(retriever, VectorStoreRetriever)
+        with _measure(timer, "embedding"):
+            embedding = await cancellation.run(
+                retriever.vectorstore.embeddings.aembed_query(query)  # type: ignore[union-attr]
+            )
+        with _measure(timer, "vector_search"):
+            return await cancellation.run(
+                retriever.vectorstore.asimilarity_search_by_vector(
+                    embedding, **retriever.search_kwargs
+                )
+            )
+
+    with _measure(timer, "search"):
+        return await cancellation.run(retriever.ainvoke(query))
+
+
+def retrieve_many(
+    retriever: BaseRetriever,
+    queries: Sequence[str],
+    max_concurrency: int = 4,
+    timer: StageTimer | None = None,
+    cancellation: CancellationToken | None = None,
+) -> list[list[Document]]:
+    cancellation = cancellation or CancellationToken()
+
+    # 複数のクエリの検索を同時に最大 max_concurrency 件まで並行して実行する
+    if len(queries) <= 1:
+        return [retrieve(retriever, query, timer, cancellation) for query in queries]
+    executor = ThreadPoolExecutor(max_workers=min(max_concurrency, len(queries)))
+    try:
+        futures: list[Future[list[Document]]] = [
+            executor.submit(retrieve, retriever, query, timer, cancellation)
+            for query in queries
+        ]
+        return [cancellation.result(future) for future in futures]
+    finally:
+        # 中断した場合は、まだ始まっていない検索を取り消して終了を待たない
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def aretrieve_many(
+    retriever: BaseRetriever,
+    queries: Sequence[str],
+    max_concurrency: int = 4,
+    timer: StageTimer | None = None,
+    cancellation: CancellationToken | None = None,
+) -> list[list[Document]]:
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def retrieve_one(query: str) -> list[Document]:
+        async with semaphore:
+            return await aretrieve(retriever, query, timer, cancellation)
+
+    return list(await asyncio.gather(*(retrieve_one(query) for query in queries)))
@@ -0,0 +1,119 @@
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Literal, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+RouteMethod = Literal["keyword", "centroid", "llm"]
+
+
+@dataclass
+class RouteDecision:
+    route: str
+    # keywordは1.0、centroidは類似度のsoftmaxで求めた確率
+    confidence: float
+    method: RouteMethod
+    # ルーティング自体にかかった時間 (質問のEmbeddingの取得は含まない)
+    elapsed_ms: float
+
+
+class LocalRouter:
+    """
+    キーワードのルールと、例文のEmbeddingの重心 (nearest-centroid) で質問の振り分け先を決めるルーター
+
+    Embeddingはプロセス内で共有したキャッシュ付きのものを使う想定で、
+    質問のEmbeddingは後段の検索でもキャッシュから再利用される。
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        examples_by_route: dict[str, Sequence[str]],
+        keywords_by_route: dict[str, Sequence[str]] | None = None,
+        min_confidence: float = 0.6,
+        temperature: float = 0.05,
+    ):
+        self.embeddings = embeddings
+        self.routes = list(examples_by_route)
+        self.min_confidence = min_confidence
+        self.temperature = temperature
+        self.keyword_patterns = {
+            route: re.compile(
+                "|".join(re.escape(keyword) for keyword in keywords), re.I
+            )
+            for route, keywords in (keywords_by_route or {}).items()
+            if keywords
+        }
+        self.stats: Counter[tuple[str, RouteMethod]] = Counter()
+        self._stats_lock = threading.Lock()
+
+        # 例文はまとめて1回でEmbeddingし、経路ごとの重心を正規化して持つ
+        texts = [text for route in self.routes for text in examples_by_route[route]]
+        vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        centroids = []
+        offset = 0
+        for route in self.routes:
+            n = len(examples_by_route[route])
+            centroid = vectors[offset : offset + n].mean(axis=0)
+            centroids.append(centroid / np.linalg.norm(centroid))
+            offset += n
+        self.centroids = np.stack(centroids)
+
+    def _match_keywords(self, question: str) -> str | None:
+        matched = [
+            route
+            for route, pattern in self.keyword_patterns.items()
+            if pattern.search(question)
+        ]
+        # 複数の経路のキーワードに一致した場合は判断しない
+        return matched[0] if len(matched) == 1 else None
+
+    def _classify(self, embedding: Sequence[float]) -> tuple[str, float]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        similarities = self.centroids @ (vector / np.linalg.norm(vector))
+        logits = (similarities - similarities.max()) / self.temperature
+        probabilities = np.exp(logits) / np.exp(logits).sum()
+        best = int(np.argmax(probabilities))
+        return self.routes[best], float(probabilities[best])
+
+    def _record(self, decision: RouteDecision) -> RouteDecision:
+        with self._stats_lock:
+            self.stats[(decision.route, decision.method)] += 1
+        return decision
+
+    def route_by_keywords(self, question: str) -> RouteDecision | None:
+        start = time.perf_counter()
+        route = self._match_keywords(question)
+        if route is None:
+            return None
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        return self._record(RouteDecision(route, 1.0, "keyword", elapsed_ms))
+
+    def route_by_embedding(self, embedding: Sequence[float]) -> RouteDecision:
+        start = time.perf_counter()
+        route, confidence = self._classify(embedding)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        decision = RouteDecision(route, confidence, "centroid", elapsed_ms)
+        # 自信度が低い場合は呼び出し側でLLMに判断させるため、まだ記録しない
+        if confidence >= self.min_confidence:
+            self._record(decision)
+        return decision
+
+    def record_llm_decision(self, route: str, confidence: float) -> RouteDecision:
+        return self._record(RouteDecision(route, confidence, "llm", 0.0))
+
+    def route(self, question: str) -> RouteDecision:
+        decision = self.route_by_keywords(question)
+        if decision is not None:
+            return decision
+        return self.route_by_embedding(self.embeddings.embed_query(question))
+
+    async def aroute(self, question: str) -> RouteDecision:
+        decision = self.route_by_keywords(question)
+        if decision is not None:
+            return decision
+        return self.route_by_embedding(await self.embeddings.aembed_query(question))
@@ -1,7 +1,18 @@
+import atexit
+import hashlib
 import json
+import logging
 import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
 import uuid
-from typing import Optional
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Iterator, Literal, Optional
 
 import faiss
 import numpy as np
@@ -13,6 +24,47 @@ from app.agent_design_pattern.settings import Settings
 
 settings = Settings()
 
+logger = logging.getLogger(__name__)
+
+ReflectionIndexType = Literal["flat", "hnsw", "ivf"]
+ReflectionStorage = Literal["float32", "float16", "pq"]
+
+# 直積量子化の各部分空間のコードのビット数 (学習には 39 * 2**8 件のベクトルが必要)
+_PQ_NBITS = 8
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    # コサイン類似度を内積で計算するため、L2ノルムを1にしたコピーを作る
+    normalized = np.array(vectors, dtype=np.float32, copy=True, order="C")
+    faiss.normalize_L2(normalized)
+    return normalized
+
+
+def _storage_of(codes: faiss.Index) -> str | None:
+    if isinstance(codes, (faiss.IndexFlat, faiss.IndexIVFFlat)):
+        return "float32"
+    if isinstance(codes, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        if codes.sq.qtype == faiss.ScalarQuantizer.QT_fp16:
+            return "float16"
+        return None
+    if isinstance(codes, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    return None
+
+
+def _index_layout_of(index: faiss.Index) -> tuple[str, str | None] | None:
+    # インデックスの種類とベクトルの持ち方の組を返す
+    if not isinstance(index, faiss.IndexIDMap2):
+        return None
+    inner = faiss.downcast_index(index.index)
+    if inner.metric_type != faiss.METRIC_INNER_PRODUCT:
+        return None
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw", _storage_of(faiss.downcast_index(inner.storage))
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf", _storage_of(inner)
+    return "flat", _storage_of(inner)
+
 
 class ReflectionJudgment(BaseModel):
     needs_retry: bool = Field(
@@ -35,77 +87,784 @@ class Reflection(BaseModel):
     judgment: ReflectionJudgment = Field(description="リトライが必要かどうかの判定")
 
 
+class _LazyReflections(MutableMapping[str, Reflection]):
+    # リフレクションの本文はJSONの文字列のまま保持し、初めて参照されたときにパースする
+    def __init__(self) -> None:
+        self._items: dict[str, str | Reflection] = {}
+
+    def set_raw(self, reflection_id: str, raw: str) -> None:
+        self._items[reflection_id] = raw
+
+    def raw(self, reflection_id: str) -> str:
+        item = self._items[reflection_id]
+        return item if isinstance(item, str) else item.model_dump_json()
+
+    def __getitem__(self, reflection_id: str) -> Reflection:
+        item = self._items[reflection_id]
+        if isinstance(item, str):
+            item = Reflection.model_validate_json(item)
+            self._items[reflection_id] = item
+        return item
+
+    def __setitem__(self, reflection_id: str, reflection: Reflection) -> None:
+        self._items[reflection_id] = reflection
+
+    def __delitem__(self, reflection_id: str) -> None:
+        del self._items[reflection_id]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def nbytes(self) -> int:
+        # パース済みの本文はJSONの文字列に直したときの大きさで見積もる
+        return sys.getsizeof(self._items) + sum(
+            sys.getsizeof(reflection_id)
+            + sys.getsizeof(item if isinstance(item, str) else item.model_dump_json())
+            for reflection_id, item in self._items.items()
+        )
+
+
+class QueryEmbeddingCache:
+    """
+    クエリのEmbeddingをメモリ上のLRUと、任意でディスク (SQLite) にキャッシュする
+
+    エージェントの1回の実行の中では、同じタスクの文章で何度も関連するリフレクションを検索するため、
+    2回目以降はEmbedding APIを呼び出さずに済むようにする。
+    """
+
+    def __init__(
+        self, model_name: str, max_entries: int = 1024, path: str | None = None
+    ):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                " key TEXT PRIMARY KEY,"
+                " vector BLOB NOT NULL"
+                ")"
+            )
+            self._connection.commit()
+
+    def _key(self, query: str) -> str:
+        normalized = " ".join(unicodedata.normalize("NFKC", query).split())
+        return hashlib.sha256(f"{self.model_name}\0{normalized}".encode()).hexdigest()
+
+    def get(self, query: str) -> np.ndarray | None:
+        key = self._key(query)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return vector
+
+            row = None
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT vector FROM query_embeddings WHERE key = ?", (key,)
+                ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        vector = np.frombuffer(row[0], dtype=np.float32)
+        self._remember(key, vector)
+        return vector
+
+    def put(self, query: str, vector: np.ndarray) -> None:
+        key = self._key(query)
+        vector = np.asarray(vector, dtype=np.float32)
+        self._remember(key, vector)
+        if self._connection is not None:
+            with self._lock:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO query_embeddings (key, vector) VALUES (?, ?)",
+                    (key, vector.tobytes()),
+                )
+                self._connection.commit()
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
 class ReflectionManager:
-    def __init__(self, file_path: str = settings.default_reflection_db_path):
+    """
+    リフレクションとそのEmbeddingを保存し、関連するリフレクションを検索する
+
+    file_path の拡張子を除いたパスをもとに、次のファイルに分けて保存する。
+    - .meta.jsonl: 1行に1件の「ID、ベクトルの行番号、リフレクションのJSON」(追記のみ)
+    - .vectors.f32: float32のEmbeddingを行番号の順に並べたもの (追記のみ、メモリマップで読む)
+    - .faiss: faiss.write_index で保存したインデックス (終了時と詰め直し時に更新)
+    - .manifest.json: Embeddingの次元数
+    - .pending.jsonl: 保存を受け付けたが、まだEmbeddingを書き込めていないリフレクション
+
+    インデックスは正規化したベクトルの内積 (コサイン類似度) で検索する近似最近傍探索
+    (HNSWまたはIVF) で、ベクトルの行番号をIDとして持つ。
+    メモリ上のベクトルはインデックスの中の1つだけで、storage で float32、float16、
+    直積量子化 (PQ、1件あたり pq_m バイト) から選ぶ。量子化した場合は rerank_factor 倍の
+    候補を取り、.vectors.f32 の元のベクトルで類似度を計算し直して並べ替える。
+    min_similarity を指定すると、類似度がそれ未満のリフレクションは返さない。
+    検索に使うクエリのEmbeddingは QueryEmbeddingCache にキャッシュする。
+
+    Embeddingの取得とファイルへの追記はバックグラウンドのスレッドでまとめて行い、
+    save_reflection は .pending.jsonl に1行追記してキューに積むだけですぐに戻る
+    (プロセスの終了時には書き込みを待つ)。Embeddingの取得に失敗した場合は間隔を空けて
+    再試行し、それでも失敗したリフレクションは次回の起動時に取り込み直す。
+    起動時はインデックスを読み込み、保存後に追記されたベクトルだけを追加する。
+    """
+
+    def __init__(
+        self,
+        file_path: str = settings.default_reflection_db_path,
+        batch_size: int = 32,
+        compaction_ratio: float = 0.5,
+        index_type: ReflectionIndexType = "hnsw",
+        min_similarity: float | None = None,
+        hnsw_m: int = 32,
+        ef_search: int = 64,
+        ivf_nlist: int = 256,
+        nprobe: int = 16,
+        storage: ReflectionStorage = "float32",
+        pq_m: int = 64,
+        rerank_factor: int = 4,
+        query_cache_size: int = 1024,
+        query_cache_path: str | None = None,
+        max_retries: int = 5,
+        retry_delay: float = 1.0,
+    ):
         self.file_path = file_path
+        base_path = os.path.splitext(file_path)[0]
+        self.meta_path = f"{base_path}.meta.jsonl"
+        self.vectors_path = f"{base_path}.vectors.f32"
+        self.index_path = f"{base_path}.faiss"
+        self.manifest_path = f"{base_path}.manifest.json"
+        self.pending_path = f"{base_path}.pending.jsonl"
+
         self.embeddings = OpenAIEmbeddings(model=settings.openai_embedding_model)
-        self.reflections: dict[str, Reflection] = {}
-        self.embeddings_dict: dict[str, list[float]] = {}
+        self.query_cache = QueryEmbeddingCache(
+            settings.openai_embedding_model,
+            max_entries=query_cache_size,
+            path=query_cache_path,
+        )
+        self.batch_size = batch_size
+        # 再試行の間隔は retry_delay 秒から倍々に延ばす
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # 無効な行の数が有効な行の数のこの割合を超えたらファイルを詰める
+        self.compaction_ratio = compaction_ratio
+        self.index_type = index_type
+        self.min_similarity = min_similarity
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.ivf_nlist = ivf_nlist
+        self.nprobe = nprobe
+        self.storage = storage
+        self.pq_m = pq_m
+        self.rerank_factor = rerank_factor
+        self.reflections = _LazyReflections()
+        self.dimension: int | None = None
         self.index = None
+        # ベクトルの行番号 (インデックスのID) に対応するリフレクションのID
+        # (対応する本文がない行は None)
+        self.index_ids: list[str | None] = []
+        self._lock = threading.RLock()
+        self._queue: queue.Queue[Reflection | None] = queue.Queue()
+        self._stale_rows = 0
+        self._index_dirty = False
+        # 保存を受け付けたが、まだファイルに書き込めていないリフレクション
+        self._unwritten: dict[str, Reflection] = {}
+        self._closing = threading.Event()
         self.load_reflections()
+        self._replay_pending()
+
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_behind, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _vectors(self, rows: int) -> np.ndarray:
+        if rows == 0 or self.dimension is None:
+            return np.empty((0, self.dimension or 0), dtype=np.float32)
+        return np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dimension)
+        )
 
     def load_reflections(self):
-        if os.path.exists(self.file_path):
-            with open(self.file_path, "r") as file:
-                data = json.load(file)
-                for item in data:
-                    reflection = Reflection(**item["reflection"])
-                    self.reflections[reflection.id] = reflection
-                    self.embeddings_dict[reflection.id] = item["embedding"]
-
-            if self.reflections:
-                embeddings = list(self.embeddings_dict.values())
-                self.index = faiss.IndexFlatL2(len(embeddings[0]))
-                self.index.add(np.array(embeddings).astype("float32"))
+        if not os.path.exists(self.manifest_path):
+            # 以前の形式 (JSONの配列、またはEmbeddingを含むJSON Lines) は新しい形式に移す
+            if os.path.exists(self.file_path):
+                self._migrate()
+            return
+
+        with open(self.manifest_path, "r", encoding="utf-8") as file:
+            self.dimension = json.load(file)["dimension"]
+        row_size = 4 * self.dimension
+        rows = 0
+        if os.path.exists(self.vectors_path):
+            size = os.path.getsize(self.vectors_path)
+            rows = size // row_size
+            # 書き込みの途中で終了した場合の半端なバイトは、以降の追記がずれないよう切り詰める
+            if size % row_size:
+                with open(self.vectors_path, "r+b") as file:
+                    file.truncate(rows * row_size)
+
+        index_ids: list[str | None] = [None] * rows
+        torn_bytes = 0
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    # 改行で終わっていない行は、書き込みの途中で終了した最後の行
+                    # (その行が指す行のベクトルは、下で参照されない行として数える)
+                    if not line.endswith("\n"):
+                        torn_bytes = len(line.encode("utf-8"))
+                        continue
+                    parts = line.rstrip("\n").split("\t", 2)
+                    # どの行のベクトルも指していないメタデータは、ここで1回だけ数える
+                    if len(parts) != 3 or not parts[1].isdigit():
+                        if line.strip():
+                            self._stale_rows += 1
+                        continue
+                    reflection_id, row, raw = parts[0], int(parts[1]), parts[2]
+                    if row >= rows:
+                        self._stale_rows += 1
+                        continue
+                    # 同じIDが重複した行のベクトルは、参照されない行として数える
+                    if reflection_id in self.reflections:
+                        continue
+                    # 本文のパースは参照されるまで遅らせる
+                    self.reflections.set_raw(reflection_id, raw)
+                    index_ids[row] = reflection_id
+        if torn_bytes:
+            # 以降の追記が半端な行につながらないよう、最後の改行までに切り詰める
+            with open(self.meta_path, "r+b") as file:
+                file.truncate(os.path.getsize(self.meta_path) - torn_bytes)
+        self.index_ids = index_ids
+        # どのリフレクションからも参照されないベクトルの行
+        self._stale_rows += sum(1 for i in index_ids if i is None)
+
+        # 保存したインデックスがあれば読み込み、その後に追記されたベクトルだけを追加する
+        vectors = self._vectors(rows)
+        index = None
+        if os.path.exists(self.index_path):
+            index = faiss.read_index(self.index_path)
+            # 種類や設定が変わった場合、ベクトルファイルと合わない場合は作り直す
+            if (
+                index.d != self.dimension
+                or index.ntotal > rows
+                or _index_layout_of(index) != self._target_layout(rows)
+            ):
+                index = None
+        if index is None:
+            self.index = self._build_index(vectors, np.arange(rows, dtype=np.int64))
+        else:
+            self._configure_index(index)
+            self.index = index
+            if index.ntotal < rows:
+                index.add_with_ids(
+                    _normalized(vectors[index.ntotal :]),
+                    np.arange(index.ntotal, rows, dtype=np.int64),
+                )
+                self._index_dirty = True
+
+        if self._stale_rows > self.compaction_ratio * max(1, len(self.reflections)):
+            self.compact()
+
+    def _migrate(self):
+        with open(self.file_path, "r", encoding="utf-8") as file:
+            content = file.read()
+        if content.lstrip().startswith("["):
+            items = json.loads(content)
+        else:
+            items = []
+            for line in content.splitlines():
+                try:
+                    items.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+
+        latest = {item["reflection"]["id"]: item for item in items}
+        if not latest:
+            return
+        reflections = [Reflection(**item["reflection"]) for item in latest.values()]
+        embeddings = np.array(
+            [item["embedding"] for item in latest.values()], dtype=np.float32
+        )
+        self._append_rows(reflections, embeddings)
+        self._save_index()
+
+    def _replay_pending(self):
+        # 前回の実行で書き込めなかったリフレクションを、もう一度キューに積む
+        if not os.path.exists(self.pending_path):
+            return
+        with open(self.pending_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    reflection = Reflection.model_validate_json(line)
+                except ValueError:
+                    # 書き込みの途中で終了した行は読み飛ばす
+                    continue
+                if reflection.id in self.reflections:
+                    continue
+                self.reflections[reflection.id] = reflection
+                self._unwritten[reflection.id] = reflection
+                self._queue.put(reflection)
+
+        with open(f"{self.pending_path}.tmp", "w", encoding="utf-8") as file:
+            file.writelines(
+                f"{reflection.model_dump_json()}\n"
+                for reflection in self._unwritten.values()
+            )
+        os.replace(f"{self.pending_path}.tmp", self.pending_path)
+        if self._unwritten:
+            logger.info("Retrying %d unwritten reflections", len(self._unwritten))
 
     def save_reflection(self, reflection: Reflection) -> str:
         reflection.id = str(uuid.uuid4())
         reflection_id = reflection.id
-        self.reflections[reflection_id] = reflection
-        embedding = self.embeddings.embed_query(reflection.reflection)
-        self.embeddings_dict[reflection_id] = embedding
+        with self._lock:
+            self.reflections[reflection_id] = reflection
+            # Embeddingを書き込めないまま終了しても失われないよう、先に本文だけを記録する
+            directory = os.path.dirname(self.pending_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.pending_path, "a", encoding="utf-8") as file:
+                file.write(f"{reflection.model_dump_json()}\n")
+            self._unwritten[reflection_id] = reflection
+
+        # Embeddingの取得と書き込みはバックグラウンドで行う
+        self._queue.put(reflection)
+        return reflection_id
 
-        if self.index is None:
-            self.index = faiss.IndexFlatL2(len(embedding))
-        self.index.add(np.array([embedding]).astype("float32"))
+    def _embed_with_retry(self, texts: list[str]) -> list[list[float]]:
+        attempt = 0
+        while True:
+            try:
+                return self.embeddings.embed_documents(texts)
+            except Exception as e:
+                # 終了中は待たずに諦め、次回の起動時に取り込み直す
+                if attempt >= self.max_retries or self._closing.is_set():
+                    raise
+                delay = self.retry_delay * 2**attempt
+                attempt += 1
+                logger.warning(
+                    "Embedding reflections failed (%s); retrying in %.1fs", e, delay
+                )
+                if self._closing.wait(delay):
+                    raise
 
-        with open(self.file_path, "w", encoding="utf-8") as file:
-            json.dump(
-                [
-                    {"reflection": reflection.dict(), "embedding": embedding}
-                    for reflection, embedding in zip(
-                        self.reflections.values(), self.embeddings_dict.values()
+    def _write_behind(self):
+        while True:
+            batch: list[Reflection] = []
+            item = self._queue.get()
+            stop = item is None
+            if item is not None:
+                batch.append(item)
+            # キューに溜まっている分はまとめて1回のAPI呼び出しと書き込みで処理する
+            while not stop and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(item)
+
+            try:
+                if batch:
+                    embeddings = self._embed_with_retry(
+                        [reflection.reflection for reflection in batch]
                     )
-                ],
-                file,
-                ensure_ascii=False,
-                indent=4,
+                    self._append_rows(batch, np.array(embeddings, dtype=np.float32))
+                    self._mark_written(batch)
+            except Exception:
+                logger.exception(
+                    "Error during saving %d reflections; "
+                    "they will be retried on the next start",
+                    len(batch),
+                )
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self._queue.task_done()
+
+            if stop:
+                return
+
+    def _mark_written(self, reflections: list[Reflection]):
+        with self._lock:
+            for reflection in reflections:
+                self._unwritten.pop(reflection.id, None)  # type: ignore[arg-type]
+            # すべて書き込めたら記録を空にする (書き込めなかったものが残っている間はそのまま)
+            if not self._unwritten and os.path.exists(self.pending_path):
+                open(self.pending_path, "w", encoding="utf-8").close()
+
+    def _append_rows(self, reflections: list[Reflection], embeddings: np.ndarray):
+        with self._lock:
+            directory = os.path.dirname(self.meta_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if self.dimension is None:
+                self.dimension = int(embeddings.shape[1])
+                self._write_manifest()
+                self.index = self._build_index(
+                    np.empty((0, self.dimension), dtype=np.float32),
+                    np.empty(0, dtype=np.int64),
+                )
+
+            # ベクトルを先に書き、本文の行が必ず書き込み済みのベクトルを指すようにする
+            first_row = len(self.index_ids)
+            with open(self.vectors_path, "ab") as file:
+                file.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+            with open(self.meta_path, "a", encoding="utf-8") as file:
+                file.writelines(
+                    f"{reflection.id}\t{first_row + i}\t{reflection.model_dump_json()}\n"
+                    for i, reflection in enumerate(reflections)
+                )
+
+            for reflection in reflections:
+                self.reflections[reflection.id] = reflection
+                self.index_ids.append(reflection.id)
+            rows = len(self.index_ids)
+            if _index_layout_of(self.index) != self._target_layout(rows):  # type: ignore[arg-type]
+                # IVFとPQは学習に十分なベクトルが集まった時点で作り直す
+                self.index = self._build_index(
+                    self._vectors(rows), np.arange(rows, dtype=np.int64)
+                )
+            else:
+                self.index.add_with_ids(  # type: ignore[union-attr]
+                    _normalized(embeddings),
+                    np.arange(first_row, rows, dtype=np.int64),
+                )
+            self._index_dirty = True
+
+            if self._stale_rows > self.compaction_ratio * len(self.reflections):
+                self.compact()
+
+    def _target_layout(self, rows: int) -> tuple[str, str]:
+        # IVFはクラスタ数に対してベクトルが少ないと学習できないため、それまでは全件探索にする
+        index_type: str = self.index_type
+        if index_type == "ivf" and rows < 39 * self.ivf_nlist:
+            index_type = "flat"
+        # PQも同様に、学習できるまでは学習の要らないfloat16で持つ
+        storage: str = self.storage
+        if storage == "pq" and rows < 39 * 2**_PQ_NBITS:
+            storage = "float16"
+        return index_type, storage
+
+    def _configure_index(self, index: faiss.Index):
+        # 検索時の精度と速度のトレードオフは保存せず、毎回設定する
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = self.ef_search
+        if isinstance(inner, faiss.IndexIVF):
+            inner.nprobe = self.nprobe
+
+    def _build_index(self, vectors: np.ndarray, ids: np.ndarray) -> faiss.Index:
+        assert self.dimension is not None
+        if self.storage == "pq" and self.dimension % self.pq_m:
+            raise ValueError(
+                f"pq_m ({self.pq_m}) must divide "
+                f"the embedding dimension ({self.dimension})"
             )
+        normalized = _normalized(vectors)
+        index_type, storage = self._target_layout(len(normalized))
+        d, metric, fp16 = (
+            self.dimension,
+            faiss.METRIC_INNER_PRODUCT,
+            faiss.ScalarQuantizer.QT_fp16,
+        )
+        if index_type == "hnsw":
+            if storage == "pq":
+                inner = faiss.IndexHNSWPQ(d, self.pq_m, self.hnsw_m, _PQ_NBITS, metric)
+            elif storage == "float16":
+                inner = faiss.IndexHNSWSQ(d, fp16, self.hnsw_m, metric)
+            else:
+                inner = faiss.IndexHNSWFlat(d, self.hnsw_m, metric)
+        elif index_type == "ivf":
+            quantizer = faiss.IndexFlatIP(d)
+            if storage == "pq":
+                inner = faiss.IndexIVFPQ(
+                    quantizer, d, self.ivf_nlist, self.pq_m, _PQ_NBITS, metric
+                )
+            elif storage == "float16":
+                inner = faiss.IndexIVFScalarQuantizer(
+                    quantizer, d, self.ivf_nlist, fp16, metric
+                )
+            else:
+                inner = faiss.IndexIVFFlat(quantizer, d, self.ivf_nlist, metric)
+        elif storage == "pq":
+            inner = faiss.IndexPQ(d, self.pq_m, _PQ_NBITS, metric)
+        elif storage == "float16":
+            inner = faiss.IndexScalarQuantizer(d, fp16, metric)
+        else:
+            inner = faiss.IndexFlatIP(d)
+        if not inner.is_trained:
+            inner.train(normalized)
 
-        return reflection_id
+        # 行番号をIDとして持たせ、検索結果からリフレクションを直接引けるようにする
+        index = faiss.IndexIDMap2(inner)
+        self._configure_index(index)
+        if len(normalized) > 0:
+            index.add_with_ids(normalized, ids)
+        self._index_dirty = True
+        return index
+
+    def _write_manifest(self):
+        with open(f"{self.manifest_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump({"dimension": self.dimension}, file)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def _save_index(self):
+        with self._lock:
+            if self.index is None or not self._index_dirty:
+                return
+            faiss.write_index(self.index, f"{self.index_path}.tmp")
+            os.replace(f"{self.index_path}.tmp", self.index_path)
+            self._index_dirty = False
+
+    def compact(self):
+        # 有効な行だけを一時ファイルに書き出してから置き換え、インデックスも作り直す
+        with self._lock:
+            vectors = self._vectors(len(self.index_ids))
+            live_rows = [
+                row
+                for row, reflection_id in enumerate(self.index_ids)
+                if reflection_id is not None
+            ]
+            live_ids = [self.index_ids[row] for row in live_rows]
+            live_vectors = np.ascontiguousarray(vectors[live_rows])
+
+            with open(f"{self.vectors_path}.tmp", "wb") as file:
+                file.write(live_vectors.tobytes())
+            with open(f"{self.meta_path}.tmp", "w", encoding="utf-8") as file:
+                file.writelines(
+                    f"{reflection_id}\t{row}\t{self.reflections.raw(reflection_id)}\n"  # type: ignore[arg-type]
+                    for row, reflection_id in enumerate(live_ids)
+                )
+            del vectors
+            os.replace(f"{self.vectors_path}.tmp", self.vectors_path)
+            os.replace(f"{self.meta_path}.tmp", self.meta_path)
+
+            self.index_ids = live_ids  # type: ignore[assignment]
+            self.index = self._build_index(
+                live_vectors, np.arange(len(live_ids), dtype=np.int64)
+            )
+            self._save_index()
+            self._stale_rows = 0
+
+    def flush(self):
+        # キューに積まれたリフレクションがすべて書き込まれるまで待つ
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._closing.set()
+        self._queue.put(None)
+        self._writer.join()
+        # 次回の起動時に作り直さずに済むよう、インデックスを保存する
+        self._save_index()
+        self.query_cache.close()
+        atexit.unregister(self.close)
 
     def get_reflection(self, reflection_id: str) -> Optional[Reflection]:
         return self.reflections.get(reflection_id)
 
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        """
+        クエリのEmbeddingをキャッシュから取得し、キャッシュにないものだけを1回の呼び出しでまとめて取得する
+        """
+        cached = [self.query_cache.get(query) for query in queries]
+        missing = list(
+            dict.fromkeys(
+                query for query, vector in zip(queries, cached) if vector is None
+            )
+        )
+        fetched: dict[str, np.ndarray] = {}
+        if missing:
+            for query, vector in zip(missing, self.embeddings.embed_documents(missing)):
+                fetched[query] = np.asarray(vector, dtype=np.float32)
+                self.query_cache.put(query, fetched[query])
+        return np.array(
+            [
+                vector if vector is not None else fetched[query]
+                for query, vector in zip(queries, cached)
+            ],
+            dtype=np.float32,
+        )
+
+    def _search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        if self.storage == "float32" or self.rerank_factor <= 1:
+            return self.index.search(queries, k)  # type: ignore[union-attr]
+
+        # 量子化したベクトルの類似度は近似なので、多めに取った候補を元のベクトルで並べ替える
+        _, candidates = self.index.search(queries, k * self.rerank_factor)  # type: ignore[union-attr]
+        vectors = self._vectors(len(self.index_ids))
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, (query, query_rows) in enumerate(zip(queries, candidates)):
+            query_rows = query_rows[query_rows >= 0]
+            if len(query_rows) == 0:
+                continue
+            exact = _normalized(vectors[query_rows]) @ query
+            order = np.argsort(-exact)[:k]
+            similarities[i, : len(order)] = exact[order]
+            rows[i, : len(order)] = query_rows[order]
+        return similarities, rows
+
+    def _exact_search(
+        self, vectors: np.ndarray, queries: np.ndarray, k: int, chunk_size: int = 65536
+    ) -> np.ndarray:
+        # ベクトルファイルを少しずつ読み、全件の内積から上位k件の行番号を求める
+        heap = faiss.ResultHeap(len(queries), k, keep_max=True)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = _normalized(vectors[start : start + chunk_size])
+            similarities, rows = faiss.knn(
+                queries, chunk, min(k, len(chunk)), metric=faiss.METRIC_INNER_PRODUCT
+            )
+            heap.add_result(similarities, np.where(rows >= 0, rows + start, -1))
+        heap.finalize()
+        return heap.I
+
+    def memory_footprint(self) -> dict[str, int]:
+        """
+        リフレクションを保持するのに使っているメモリのバイト数の見積もりを返す
+
+        - vectors: インデックスの中のベクトル (またはその量子化コード)
+        - index: HNSWのグラフ、IVFのリストとクラスタの中心、PQのコードブック、IDの対応表
+        - metadata: リフレクションのIDと本文 (Pythonのオブジェクト)
+        """
+        with self._lock:
+            vectors = structure = 0
+            index = self.index
+            if index is not None:
+                ntotal = index.ntotal
+                inner = faiss.downcast_index(index.index)
+                codes = inner
+                if isinstance(inner, faiss.IndexHNSW):
+                    codes = faiss.downcast_index(inner.storage)
+                    structure += 4 * inner.hnsw.neighbors.size()
+                    structure += 4 * inner.hnsw.levels.size()
+                    structure += 8 * inner.hnsw.offsets.size()
+                if isinstance(inner, faiss.IndexIVF):
+                    # 転置リストのIDとクラスタの中心
+                    structure += 8 * ntotal + 4 * inner.quantizer.ntotal * inner.d
+                if isinstance(codes, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+                    structure += 4 * codes.pq.centroids.size()
+                vectors = codes.code_size * ntotal
+                # IndexIDMap2 の行番号の配列と、その逆引きのハッシュ表 (1件あたり約32バイト)
+                structure += 8 * index.id_map.size() + 32 * ntotal
+
+            metadata = sys.getsizeof(self.index_ids) + self.reflections.nbytes()
+            return {
+                "vectors": vectors,
+                "index": structure,
+                "metadata": metadata,
+                "total": vectors + structure + metadata,
+            }
+
+    def evaluate_recall(
+        self, k: int = 10, sample_size: int = 1000, seed: int = 0
+    ) -> dict[str, float]:
+        """
+        保存済みのベクトルから sample_size 件を選んでクエリにし、検索結果の上位k件のうち
+        全件探索 (元のfloat32のベクトル) の上位k件と一致する割合 (recall@k) を返す
+
+        latency_ms と exact_latency_ms は、それぞれの1クエリあたりの検索時間 (ミリ秒)。
+        """
+        with self._lock:
+            rows = len(self.index_ids)
+        if rows == 0 or self.index is None:
+            return {"recall": 0.0, "queries": 0}
+
+        vectors = self._vectors(rows)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(rows, size=min(sample_size, rows), replace=False))
+        queries = _normalized(vectors[sample])
+        k = min(k, rows)
+
+        start = time.perf_counter()
+        with self._lock:
+            _, approximate = self._search(queries, k)
+        latency = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact = self._exact_search(vectors, queries, k)
+        exact_latency = time.perf_counter() - start
+
+        hits = sum(
+            len(set(found[found >= 0].tolist()) & set(expected.tolist()))
+            for found, expected in zip(approximate, exact)
+        )
+        return {
+            "recall": hits / (k * len(queries)),
+            "queries": len(queries),
+            "latency_ms": 1000 * latency / len(queries),
+            "exact_latency_ms": 1000 * exact_latency / len(queries),
+        }
+
     def get_relevant_reflections(self, query: str, k: int = 3) -> list[Reflection]:
-        if not self.reflections or self.index is None:
-            return []
+        return self.get_relevant_reflections_batch([query], k=k)[0]
+
+    def get_relevant_reflections_batch(
+        self, queries: list[str], k: int = 3
+    ) -> list[list[Reflection]]:
+        if not queries or not self.index_ids or self.index is None:
+            return [[] for _ in queries]
 
-        query_embedding = self.embeddings.embed_query(query)
         try:
-            D, I = self.index.search(
-                np.array([query_embedding]).astype("float32"),
-                min(k, len(self.reflections)),
-            )
-            reflection_ids = list(self.reflections.keys())
+            query_embeddings = self.embed_queries(queries)
+            with self._lock:
+                similarities, rows = self._search(_normalized(query_embeddings), k)
+                # 関連の薄いリフレクションでプロンプトを水増ししないよう、類似度で足切りする
+                reflection_ids = [
+                    [
+                        self.index_ids[row]
+                        for similarity, row in zip(query_similarities, query_rows)
+                        if 0 <= row < len(self.index_ids)
+                        and (
+                            self.min_similarity is None
+                            or similarity >= self.min_similarity
+                        )
+                    ]
+                    for query_similarities, query_rows in zip(similarities, rows)
+                ]
             return [
-                self.reflections[reflection_ids[i]]
-                for i in I[0]
-                if i < len(reflection_ids)
+                [
+                    self.reflections[reflection_id]
+                    for reflection_id in query_reflection_ids
+                    if reflection_id is not None
+                ]
+                for query_reflection_ids in reflection_ids
             ]
-        except Exception as e:
-            print(f"Error during reflection search: {e}")
-            return []
+        except Exception:
+            logger.exception("Error during reflection search")
+            return [[] for _ in queries]
 
 
 _task_reflector_prompt_template = """
@@ -3,44 +3,509 @@
 
 実行方法:
     uv run python app/chat_cli.py
+    uv run python app/chat_cli.py --stream  # 応答を生成しながら表示する
+    uv run python app/chat_cli.py --memory-budget 2000  # 会話履歴のトークン数の上限を指定する
+    uv run python app/chat_cli.py --list-sessions  # 保存されている会話の一覧を表示する
+    uv run python app/chat_cli.py --session <ID>  # 保存されている会話を再開する (IDは先頭の一部でもよい)
 
 停止方法:
     Ctrl + C
 """
 
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from typing import Any, Callable, Generator, Sequence
+
 from dotenv import load_dotenv
 from openai import OpenAI
 from openai.types.chat import ChatCompletionMessageParam
 
+MODEL = "gpt-5-nano"
+
+DEVELOPER_MESSAGE = "You are a helpful assistant."
+
+DEFAULT_SESSION_DB_PATH = "./tmp/chat_sessions.sqlite3"
+
+_summary_prompt_template = """\
+これまでの会話の要約と、その続きの会話があります。
+続きの会話の内容を要約に統合し、後の会話で必要になる事実や決定事項を落とさずに簡潔にまとめてください。
+
+これまでの要約:
+{summary}
+
+続きの会話:
+{conversation}
+"""
+
+_cjk_pattern = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+@lru_cache(maxsize=1)
+def _get_encoding() -> Any:
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # オフライン環境などでエンコーディングを取得できない場合は概算する
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    # 日本語は1文字1トークン程度、それ以外は4文字1トークン程度として概算する
+    cjk_chars = len(_cjk_pattern.findall(text))
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+
+def _message_tokens(message: ChatCompletionMessageParam) -> int:
+    # ロールなどのメッセージごとのオーバーヘッドとして数トークンを加える
+    return count_tokens(str(message.get("content") or "")) + 4
+
+
+class ConversationMemory:
+    """
+    トークン数の上限を超えないように会話履歴を管理する
+
+    developerメッセージと直近のやり取りはそのまま残し、古いやり取りは要約に畳み込む。
+    要約はバックグラウンドで更新するため、次の応答の生成を待たせない
+    (要約が終わるまでは、畳み込む予定のやり取りもそのまま送る)。
+    """
+
+    def __init__(
+        self,
+        client: OpenAI,
+        developer_message: str = DEVELOPER_MESSAGE,
+        token_budget: int = 4000,
+        recent_ratio: float = 0.5,
+        on_summary: Callable[[str, int], None] | None = None,
+    ):
+        self.client = client
+        self.developer_message = developer_message
+        self.token_budget = token_budget
+        # 要約するときに、そのまま残す直近のやり取りのトークン数の割合
+        self.recent_ratio = recent_ratio
+        # 要約を更新したときに (要約, 要約に畳み込んだメッセージの数) で呼び出す
+        self.on_summary = on_summary
+
+        self.summary = ""
+        # 会話の先頭から何件のメッセージを要約に畳み込んだか
+        self.folded_count = 0
+        self.turns: list[ChatCompletionMessageParam] = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Future[None] | None = None
+
+    def restore(
+        self,
+        summary: str,
+        folded_count: int,
+        turns: Sequence[ChatCompletionMessageParam],
+    ) -> None:
+        with self._lock:
+            self.summary = summary
+            self.folded_count = folded_count
+            self.turns = list(turns)
+
+    def messages(self) -> list[ChatCompletionMessageParam]:
+        with self._lock:
+            messages: list[ChatCompletionMessageParam] = [
+                {"role": "developer", "content": self.developer_message}
+            ]
+            if self.summary:
+                messages.append(
+                    {
+                        "role": "developer",
+                        "content": f"これまでの会話の要約:\n{self.summary}",
+                    }
+                )
+            messages.extend(self.turns)
+            return messages
+
+    def append(self, message: ChatCompletionMessageParam) -> None:
+        with self._lock:
+            self.turns.append(message)
+            if self._pending is not None or self._total_tokens() <= self.token_budget:
+                return
+
+            # 直近のやり取りが recent_ratio の割合に収まるように、古いものから要約に回す
+            # (やり取りの途中で区切らないよう、残す先頭は user のメッセージにする)
+            keep_tokens = int(self.token_budget * self.recent_ratio)
+            kept = 0
+            split = len(self.turns)
+            for i in range(len(self.turns) - 1, -1, -1):
+                kept += _message_tokens(self.turns[i])
+                if kept > keep_tokens:
+                    break
+                if self.turns[i]["role"] == "user":
+                    split = i
+            if split == 0 or split == len(self.turns):
+                split = max(0, len(self.turns) - 2)
+            if split == 0:
+                return
+
+            folded = list(self.turns[:split])
+            self._pending = self._executor.submit(self._summarize, self.summary, folded)
+
+    def _total_tokens(self) -> int:
+        return (
+            count_tokens(self.developer_message)
+            + count_tokens(self.summary)
+            + sum(_message_tokens(message) for message in self.turns)
+        )
+
+    def _summarize(
+        self, summary: str, folded: list[ChatCompletionMessageParam]
+    ) -> None:
+        try:
+            conversation = "\n".join(
+                f"{message['role']}: {message.get('content')}" for message in folded
+            )
+            response = self.client.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": _summary_prompt_template.format(
+                            summary=summary or "(なし)", conversation=conversation
+                        ),
+                    }
+                ],
+                reasoning_effort="minimal",
+            )
+            new_summary = response.choices[0].message.content or summary
+        except Exception as e:
+            # 要約に失敗しても会話は続け、次に上限を超えたときにやり直す
+            print(f"(failed to summarize conversation: {e})", file=sys.stderr)
+            with self._lock:
+                self._pending = None
+            return
+
+        # 要約している間は末尾への追加しか起きないため、先頭の folded 件を置き換えればよい
+        with self._lock:
+            self.summary = new_summary
+            self.folded_count += len(folded)
+            folded_count = self.folded_count
+            del self.turns[: len(folded)]
+            self._pending = None
+        if self.on_summary is not None:
+            self.on_summary(new_summary, folded_count)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+@dataclass
+class Session:
+    id: str
+    title: str
+    created_at: float
+    updated_at: float
+    message_count: int
+
+
+@dataclass
+class SessionHistory:
+    summary: str
+    # summary に畳み込まれているメッセージの数 (messages はその続きから)
+    folded_count: int
+    messages: list[ChatCompletionMessageParam]
 
-def generate(messages: list[ChatCompletionMessageParam]) -> str:
-    client = OpenAI()
 
+class ConversationStore:
+    """
+    会話をSQLiteに保存し、後から再開できるようにする
+
+    1回のやり取りは、メッセージの追加とセッションの更新日時の更新だけの1トランザクションで書き込み、
+    過去のメッセージを書き直すことはない。要約も更新のたびに追加し、最新のものだけを読み込む。
+    """
+
+    def __init__(self, path: str = DEFAULT_SESSION_DB_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 要約はバックグラウンドのスレッドから書き込むため、接続をロックで保護する
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS sessions_updated_at
+                ON sessions (updated_at DESC);
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT NOT NULL,
+                folded_count INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (session_id, folded_count)
+            ) WITHOUT ROWID;
+            """
+        )
+        self._connection.commit()
+
+    def create_session(self, title: str) -> Session:
+        now = time.time()
+        session = Session(
+            id=uuid.uuid4().hex,
+            title=title[:80],
+            created_at=now,
+            updated_at=now,
+            message_count=0,
+        )
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO sessions (id, title, created_at, updated_at, message_count)"
+                " VALUES (?, ?, ?, ?, 0)",
+                (session.id, session.title, now, now),
+            )
+        return session
+
+    def list_sessions(self, limit: int = 20) -> list[Session]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, title, created_at, updated_at, message_count"
+                " FROM sessions ORDER BY updated_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [Session(*row) for row in rows]
+
+    def find_session(self, session_id: str) -> Session | None:
+        # IDの先頭の一部だけでも、主キーの範囲検索で探せるようにする
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, title, created_at, updated_at, message_count"
+                " FROM sessions WHERE id >= ? AND id < ? ORDER BY id LIMIT 2",
+                (session_id, session_id + "\uffff"),
+            ).fetchall()
+        if len(rows) != 1:
+            return None
+        return Session(*rows[0])
+
+    def load(self, session_id: str) -> SessionHistory:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT folded_count, content FROM summaries"
+                " WHERE session_id = ? ORDER BY folded_count DESC LIMIT 1",
+                (session_id,),
+            ).fetchone()
+            folded_count, summary = row if row is not None else (0, "")
+            rows = self._connection.execute(
+                "SELECT role, content FROM messages"
+                " WHERE session_id = ? AND seq >= ? ORDER BY seq",
+                (session_id, folded_count),
+            ).fetchall()
+        return SessionHistory(
+            summary=summary,
+            folded_count=folded_count,
+            messages=[{"role": role, "content": content} for role, content in rows],  # type: ignore[misc]
+        )
+
+    def append_messages(
+        self, session_id: str, messages: Sequence[ChatCompletionMessageParam]
+    ) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            (message_count,) = self._connection.execute(
+                "SELECT message_count FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            self._connection.executemany(
+                "INSERT INTO messages (session_id, seq, role, content, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        session_id,
+                        message_count + i,
+                        message["role"],
+                        str(message.get("content") or ""),
+                        now,
+                    )
+                    for i, message in enumerate(messages)
+                ],
+            )
+            self._connection.execute(
+                "UPDATE sessions SET updated_at = ?, message_count = ? WHERE id = ?",
+                (now, message_count + len(messages), session_id),
+            )
+
+    def append_summary(self, session_id: str, summary: str, folded_count: int) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO summaries"
+                " (session_id, folded_count, content, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, folded_count, summary, time.time()),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def generate(client: OpenAI, messages: list[ChatCompletionMessageParam]) -> str:
     response = client.chat.completions.create(
-        model="gpt-5-nano",
+        model=MODEL,
         messages=messages,
         reasoning_effort="minimal",
     )
     return response.choices[0].message.content  # type: ignore[return-value]
 
 
-def main() -> None:
-    load_dotenv(override=True)
+def generate_stream(
+    client: OpenAI, messages: list[ChatCompletionMessageParam]
+) -> Generator[str, None, None]:
+    stream = client.chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        reasoning_effort="minimal",
+        stream=True,
+    )
+    # 途中で中断された場合も接続を閉じてコネクションプールに返す
+    with stream:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
 
-    # 会話履歴を初期化
-    messages: list[ChatCompletionMessageParam] = [
-        {"role": "developer", "content": "You are a helpful assistant."},
-    ]
+def print_stream(client: OpenAI, messages: list[ChatCompletionMessageParam]) -> str:
+    # 生成しながら表示し、最初のトークンまでの時間と全体の時間を表示する
+    print("Assistant: ", end="", flush=True)
+    start = time.perf_counter()
+    time_to_first_token: float | None = None
+    tokens: list[str] = []
+    for token in generate_stream(client=client, messages=messages):
+        if time_to_first_token is None:
+            time_to_first_token = time.perf_counter() - start
+        tokens.append(token)
+        print(token, end="", flush=True)
+    total = time.perf_counter() - start
+    print()
+    print(
+        f"(time to first token: {(time_to_first_token or total) * 1000:.0f}ms, "
+        f"total: {total * 1000:.0f}ms)"
+    )
+    return "".join(tokens)
+
+
+def chat(
+    client: OpenAI,
+    memory: ConversationMemory,
+    store: ConversationStore,
+    session: Session | None,
+    stream: bool,
+) -> None:
+    if session is not None:
+        memory.on_summary = partial(store.append_summary, session.id)
 
     while True:
         # ユーザーの入力を受け付けて会話履歴に追加
         user_message = input("User: ")
-        messages.append({"role": "user", "content": user_message})
+        memory.append({"role": "user", "content": user_message})
+        messages = memory.messages()
 
         # LLMによる応答を生成して会話履歴に追加
-        ai_message = generate(messages=messages)
-        messages.append({"role": "assistant", "content": ai_message})
-        print(f"Assistant: {ai_message}")
+        if not stream:
+            ai_message = generate(client=client, messages=messages)
+            print(f"Assistant: {ai_message}")
+        else:
+            ai_message = print_stream(client=client, messages=messages)
+
+        # セッションは最初のやり取りを終えた時点で作り、以降はやり取りごとに追記する
+        if session is None:
+            session = store.create_session(title=user_message)
+            memory.on_summary = partial(store.append_summary, session.id)
+            print(f"(session: {session.id})")
+        memory.append({"role": "assistant", "content": ai_message})
+        store.append_messages(
+            session.id,
+            [
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": ai_message},
+            ],
+        )
+
+
+def main() -> None:
+    load_dotenv(override=True)
+
+    parser = argparse.ArgumentParser(description="LLMと対話します")
+    parser.add_argument(
+        "--stream", action="store_true", help="応答を生成しながら表示する"
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=4000,
+        help="会話履歴のトークン数の上限 (超えた分は要約する)",
+    )
+    parser.add_argument("--session", type=str, help="再開する会話のID")
+    parser.add_argument(
+        "--list-sessions",
+        action="store_true",
+        help="保存されている会話の一覧を表示する",
+    )
+    parser.add_argument("--db-path", type=str, default=DEFAULT_SESSION_DB_PATH)
+    args = parser.parse_args()
+
+    store = ConversationStore(args.db_path)
+    if args.list_sessions:
+        for session in store.list_sessions():
+            updated_at = time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(session.updated_at)
+            )
+            print(
+                f"{session.id}  {updated_at}  "
+                f"{session.message_count:>4} messages  {session.title}"
+            )
+        store.close()
+        return
+
+    # クライアント (HTTPのコネクションプール) はセッションを通して使い回す
+    client = OpenAI()
+
+    # 会話履歴を初期化 (再開する場合は保存されている要約と続きのメッセージを読み込む)
+    memory = ConversationMemory(client=client, token_budget=args.memory_budget)
+    session: Session | None = None
+    if args.session:
+        session = store.find_session(args.session)
+        if session is None:
+            parser.error(f"session not found: {args.session}")
+        history = store.load(session.id)
+        memory.restore(history.summary, history.folded_count, history.messages)
+        print(f"(resumed session: {session.id}, {session.message_count} messages)")
+
+    try:
+        chat(client, memory, store, session, stream=args.stream)
+    finally:
+        # 実行中の要約を書き込み終えてから閉じる
+        memory.close()
+        store.close()
 
 
 if __name__ == "__main__":